@@ -11,33 +11,47 @@ also, one row of one table was a column short. although the missing column
 was most likely 2nd from the left, can't count on that. so just append one.
 not dealing with extra columns for now, since there don't seem to be any.
 
-NOTE: this must only be used on short files, as it buffers the entire
-file in RAM!
+the file is streamed a row at a time, the first row deciding whether it is
+"bad" or not, so it can be used on files of any size, and as a filter, e.g.
+to feed left_outer_join.py through process substitution.
 '''
 from __future__ import print_function
 import sys, os, csv, logging
+import csvio
 logging.basicConfig(level=logging.DEBUG if __debug__ else logging.INFO)
 sys.setcheckinterval(1000000000)
 
 def process():
-    reader = csv.reader(sys.stdin, delimiter='|')
-    writer = csv.writer(sys.stdout, lineterminator='\n')
-    firstpass = [r for r in reader]
-    logging.debug('first pass: %s', firstpass[:2])
-    if len(firstpass[0]) > 1:
+    r'''
+    >>> from io import BytesIO
+    >>> sys.stdin = BytesIO('"a|b|c"\n"1|""x y""|3"\n"4|5"\n')
+    >>> process()
+    a,b,c
+    1,x y,3
+    4,5,
+    >>> sys.stdin = BytesIO('a|b\n1|2\n')
+    >>> process()
+    a,b
+    1,2
+    '''
+    reader = csvio.reader(delimiter='|')
+    writer = csvio.writer()
+    first = reader.next()
+    logging.debug('first row: %s', first)
+    if len(first) > 1:
         # assume it was not a "bad" file after all.
-        writer.writerows(firstpass)
+        writer.writerow(first)
+        writer.writerows(reader)
         return
-    # presumed bad, so now read the normal CSV record
-    finalpass = [csv.reader(r, delimiter='|').next() for r in firstpass]
-    logging.debug('final pass: %s', finalpass[:2])
+    # presumed bad, so now read the normal CSV record from each row
+    header = csv.reader(first, delimiter='|').next()
+    logging.debug('header: %s', header)
+    writer.writerow(header)
     logging.debug('correcting any short rows...')
-    header = finalpass[0]
-    for row in finalpass:
-        # I know this is horribly inefficient but it's only meant to
-        # deal with *one* column in *one* row of *one* table
-        while len(row) < len(header):
-            row += ['']
+    for record in reader:
+        row = csv.reader(record, delimiter='|').next()
+        if len(row) < len(header):
+            row.extend([''] * (len(header) - len(row)))
         writer.writerow(row)
     logging.debug('done corrections')
 
@@ -0,0 +1,234 @@
+#!/usr/bin/python -OO
+'''
+time each of the filters, and the Makefile pipeline, on synthetic data
+from generate.py, and compare with a saved baseline.
+
+e.g. `./benchmark.py --rows=1000000 --save` once, then `./benchmark.py
+--rows=1000000` after each change. for each benchmark, the best of
+--repeat runs (3 by default) is reported, as rows and megabytes of input
+per second, along with the peak resident set size of the process and any
+it waited for, such as `make`'s children or a pool of workers.
+
+the baseline is kept in --baseline (benchmark.json by default, which git
+ignores); any benchmark slower than it, or bigger in memory, by more than
+--tolerance (0.2 by default, as a fraction) is marked as a regression, and
+the exit status is then 1. --save replaces the baseline with the results of
+the run. other options, such as --skew, are passed on to generate.py. the
+data and the outputs are kept under --directory (/tmp/benchmark by default).
+'''
+from __future__ import print_function
+import sys, os, csv, time, json, shutil, subprocess, logging
+from itertools import chain
+import csvio, generate
+logging.basicConfig(level=logging.DEBUG if __debug__ else logging.INFO)
+HERE = os.path.dirname(os.path.abspath(__file__))
+# name, command, stdin and stdout, relative to the directory. {directory}
+# is replaced in each. later ones take the outputs of earlier ones. the
+# rows and bytes of input are those of stdin and of any files in the
+# command, or for make, those of all the data.
+BENCHMARKS = [
+    ('removeheaders', ['removeheaders.py'], 'parts.csv', 'combined.csv'),
+    ('calculate', ['calculate.py', 'net', 'gross', '-expenses'],
+     'data/sales.csv', 'calculated.csv'),
+    ('calculate --batch', ['calculate.py', 'net', 'gross', '-expenses',
+                           '--batch'], 'data/sales.csv', None),
+    ('deduplicate', ['deduplicate.py', 'all but one', '_any_',
+                     'id', '_any_'], 'data/sales.csv', None),
+    ('min_digits', ['min_digits.py'], 'calculated.csv', None),
+    ('reorder', ['reorder.py'], 'reorder.csv', None),
+    ('goodpsv', ['goodpsv.py'], 'sales.psv', None),
+    ('badpsv', ['badpsv.py'], 'bad.psv', None),
+    ('left_outer_join', ['left_outer_join.py', 'id',
+                         '{directory}/calculated.csv'],
+     'combined.csv', 'joined.csv'),
+    ('left_outer_join probe', ['left_outer_join.py', 'id',
+                               '{directory}/combined.csv'],
+     'calculated.csv', None),
+    ('make', ['make', '-s', 'all', 'fused', 'INPUT={directory}/make',
+              'PYTHON={python} -OO'], None, None),
+]
+# measures compared with the baseline, and whether more is better
+MEASURES = [('rows_per_second', True), ('mb_per_second', True),
+            ('peak_rss_mb', False)]
+
+def process(directory='/tmp/benchmark', repeat=3, baseline=None,
+            tolerance=0.2, save=False, **options):
+    '''
+    generate the data, run the benchmarks, and report on them
+    '''
+    repeat, tolerance = int(repeat), float(tolerance)
+    baseline = baseline or os.path.join(HERE, 'benchmark.json')
+    generate.process(os.path.join(directory, 'data'), **options)
+    derive(directory)
+    previous = {}
+    if os.path.exists(baseline):
+        with open(baseline) as infile:
+            previous = json.load(infile)
+    results, regressions = {}, []
+    print(header())
+    for name, command, infile, outfile in BENCHMARKS:
+        result = benchmark(directory, command, infile, outfile, repeat)
+        results[name] = result
+        regressed = compare(result, previous.get(name), tolerance)
+        if regressed:
+            regressions.append(name)
+        print(report(name, result, previous.get(name), regressed))
+    if save:
+        with open(baseline, 'w') as outfile:
+            json.dump(results, outfile, indent=1, sort_keys=True)
+        logging.info('saved baseline %s', baseline)
+    if regressions:
+        logging.error('regressions: %s', ', '.join(regressions))
+        sys.exit(1)
+
+def derive(directory):
+    '''
+    write the inputs of the filters that don't take the generated tables
+    as they are: the tables to concatenate for removeheaders.py; sales.csv
+    under a header with its columns in another order, for reorder.py; and
+    as PSV, and as the PSV wrapped up as a column of CSV, for goodpsv.py
+    and badpsv.py.
+    '''
+    with open(os.path.join(directory, 'parts.csv'), 'wb') as outfile:
+        for name in ('billing.csv', 'salesmen.csv'):
+            with open(os.path.join(directory, 'data', name), 'rb') as infile:
+                shutil.copyfileobj(infile, outfile)
+    with open(os.path.join(directory, 'data', 'sales.csv'), 'rb') as infile, \
+            open(os.path.join(directory, 'reorder.csv'), 'wb') as reordered, \
+            open(os.path.join(directory, 'sales.psv'), 'wb') as good, \
+            open(os.path.join(directory, 'bad.psv'), 'wb') as bad:
+        rows = csvio.reader(infile)
+        header = next(rows)
+        order = range(1, len(header)) + [0]
+        writer = csvio.Writer(reordered)
+        writer.writerow(header)
+        psv = csv.writer(good, delimiter='|', lineterminator='\n')
+        wrapped = csv.writer(bad, quoting=csv.QUOTE_ALL, lineterminator='\n')
+        for row in chain([header], rows):
+            writer.writerow([row[n] for n in order])
+            psv.writerow(row)
+            wrapped.writerow(['|'.join(row)])
+
+def benchmark(directory, command, infile, outfile, repeat):
+    '''
+    dict of the measures of the best of `repeat` runs of command
+    '''
+    values = {'directory': directory, 'python': sys.executable}
+    command = [part.format(**values) for part in command]
+    if command[0].endswith('.py'):
+        command = [sys.executable, '-OO', os.path.join(HERE, command[0])
+                  ] + command[1:]
+    if infile is None:
+        inputs = [os.path.join(directory, 'data', name) for name in
+                  ('sales.csv', 'salesmen.csv', 'billing.csv')]
+    else:
+        inputs = [os.path.join(directory, infile)] + [
+            part for part in command[1:] if os.path.isfile(part)]
+    rows = sum(count_rows(filename) for filename in inputs)
+    size = sum(os.path.getsize(filename) for filename in inputs)
+    runs = []
+    for run in range(repeat):
+        if infile is None:
+            fresh_make(directory)
+        runs.append(measure(command,
+                            inputs[0] if infile is not None else None,
+                            os.path.join(directory, outfile)
+                            if outfile else os.devnull))
+    seconds = min(seconds for seconds, rss, status in runs)
+    result = {'seconds': seconds, 'rows': rows, 'bytes': size,
+              'rows_per_second': rows / seconds,
+              'mb_per_second': size / seconds / 1024 / 1024,
+              'peak_rss_mb': max(rss for seconds, rss, status in runs)}
+    if any(status for seconds, rss, status in runs):
+        result['failed'] = True
+    return result
+
+def measure(command, infile, outfile):
+    '''
+    seconds, peak RSS in megabytes, and exit status of command, reading
+    infile, if any, and writing outfile
+    '''
+    logging.debug('running %s', command)
+    stdin = open(infile, 'rb') if infile else open(os.devnull, 'rb')
+    with stdin, open(outfile, 'wb') as stdout:
+        start = time.time()
+        child = subprocess.Popen(command, stdin=stdin, stdout=stdout,
+                                 cwd=HERE)
+        status, usage = os.wait4(child.pid, 0)[1:]
+        seconds = time.time() - start
+    child.returncode = status  # already reaped
+    # Linux gives ru_maxrss in kilobytes, BSD and OS X in bytes
+    scale = 1024 ** (1 if sys.platform.startswith('linux') else 2)
+    return seconds, usage.ru_maxrss / float(scale), status
+
+def fresh_make(directory):
+    '''
+    set up an INPUT directory with nothing made in it yet, for `make`
+    '''
+    makedir = os.path.join(directory, 'make')
+    if os.path.isdir(makedir):
+        shutil.rmtree(makedir)
+    os.makedirs(makedir)
+    os.symlink(os.path.join(directory, 'data'),
+               os.path.join(makedir, 'data'))
+
+def count_rows(filename):
+    '''
+    number of records in a file, header included
+    '''
+    with csvio.open_file(filename) as infile:
+        return sum(1 for row in csvio.reader(infile))
+
+def compare(result, previous, tolerance):
+    '''
+    list of the measures worse than previous by more than tolerance
+
+    >>> compare({'rows_per_second': 70, 'mb_per_second': 1,
+    ...          'peak_rss_mb': 11}, {'rows_per_second': 100,
+    ...          'mb_per_second': 1, 'peak_rss_mb': 10}, 0.2)
+    ['rows_per_second']
+    '''
+    if not previous:
+        return []
+    worse = []
+    for measure, higher in MEASURES:
+        if higher:
+            if result[measure] < previous[measure] * (1 - tolerance):
+                worse.append(measure)
+        elif result[measure] > previous[measure] * (1 + tolerance):
+            worse.append(measure)
+    if result.get('failed'):
+        worse.append('failed')
+    return worse
+
+def header():
+    '''
+    the column headings of the report
+    '''
+    return '%-24s %8s %10s %8s %8s  %s' % (
+        'benchmark', 'seconds', 'rows/s', 'MB/s', 'peak MB', 'baseline')
+
+def report(name, result, previous, regressed):
+    '''
+    a line of the report
+
+    >>> report('x', {'seconds': 2.0, 'rows_per_second': 500.0,
+    ...        'mb_per_second': 0.5, 'peak_rss_mb': 9.0},
+    ...        {'rows_per_second': 1000.0}, ['rows_per_second']).split()[1:]
+    ['2.00', '500', '0.50', '9.0', '-50%', 'REGRESSION', 'rows_per_second']
+    '''
+    line = '%-24s %8.2f %10.0f %8.2f %8.1f' % (
+        name, result['seconds'], result['rows_per_second'],
+        result['mb_per_second'], result['peak_rss_mb'])
+    if previous:
+        line += '  %+.0f%%' % (100 * (result['rows_per_second'] /
+                                      previous['rows_per_second'] - 1))
+    if regressed:
+        line += ' REGRESSION ' + ', '.join(regressed)
+    return line
+
+if __name__ == '__main__':
+    ARGS = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    OPTIONS = dict((arg[2:].split('=', 1) + [True])[:2]
+                   for arg in sys.argv[1:] if arg.startswith('--'))
+    process(*ARGS, **OPTIONS)
@@ -5,19 +5,53 @@ calculate new column from other, existing, columns
 assumes "add" unless column name begins with '-'. NOTE that some columns
 are named with leading asterisks, so we cannot use that for multiplication
 with this scheme.
+
+with --batch, or --batch=ROWS, rows are read in blocks (of BATCH rows by
+default), and the columns used converted and summed as NumPy arrays.
+
+input in the columnar format of columnar.py is summed a chunk at a time,
+without NumPy, each column taken as floats parsed once per distinct value.
+
+for anything more, give one or more `name=expression` args instead, e.g.:
+    ./calculate.py 'net=[gross] - [expenses]' 'margin=[net] / [gross]' \
+        'tax=[*taxable] * 0.08'
+column names go in square brackets, so may start with '*' or anything
+else but ']'; expressions may use numbers, + - * / and parentheses, and
+columns calculated by the expressions before them. empty cells are 0.
+division by zero gives inf or nan, as with NumPy, rather than an error,
+with or without --batch. args are taken as expressions only if they all
+have an '=' in them and none of them is a column of the input, so column
+names with '=' in them still work the old way.
 '''
 from __future__ import print_function
-import sys, os, csv, logging
+import sys, os, logging, re, math
+from itertools import islice
+from operator import add, sub
+import csvio, columnar, stats
+# imported by import_numpy, only for --batch
+numpy = None
 logging.basicConfig(level=logging.DEBUG if __debug__ else logging.INFO)
 sys.setcheckinterval(1000000000)
+BATCH = 65536
+
+def process(columns, batch=None):
+    '''
+    write stdin to stdout with the result column calculated from the others
 
-def process(columns):
-    result_name = columns.pop(0)
-    reader = csv.reader(sys.stdin)
-    writer = csv.writer(sys.stdout, lineterminator='\n')
+    if `batch` is given, hand off to process_batches for rows of a new
+    result column.
+
+    if the columns are all of the form name=expression, they are handled
+    instead by process_expressions.
+    '''
+    reader = csvio.reader()
+    writer = csvio.writer()
     additions, subtractions = [], []
     try:
         header = reader.next()
+        if is_expressions(columns, header):
+            return process_expressions(columns, reader, writer, header, batch)
+        result_name = columns.pop(0)
         if result_name in header:
             result_index = header.index(result_name)
         else:
@@ -40,22 +74,485 @@ def process(columns):
     except IOError:
         logging.debug('apparently pipeline was shut down')
         sys.exit(1)
+    if isinstance(reader, columnar.Reader) and result_index == -1:
+        return process_chunks(reader, writer, additions, subtractions,
+                              header)
+    if batch and result_index == -1:
+        import_numpy()
+        size = BATCH if batch is True else int(batch)
+        return process_batches(reader, writer, additions, subtractions,
+                               header, size)
     for row in reader:
-        if result_index == -1:
-            row.append(0.0)
-        for index in additions:
-            try:
-                row[result_index] += float(row[index] or '0')
-            except (TypeError, ValueError):
-                raise(ValueError('could not add %s with %s' % (
-                    row[index], row[-1])))
-        for index in subtractions:
-            try:
-                row[result_index] -= float(row[index] or '0')
-            except (TypeError, ValueError):
-                raise(ValueError('could not add %s with %s' % (
-                    row[index], row[-1])))
+        calculate_row(row, result_index, additions, subtractions, header)
         writer.writerow(row)
 
+def calculate_row(row, result_index, additions, subtractions, header):
+    '''
+    add or replace the result in a row, in place
+
+    >>> row = ['1', 'x']
+    >>> calculate_row(row, -1, [0, 1], [], ['a', 'b', 'c'])
+    Traceback (most recent call last):
+        ...
+    ValueError: could not convert 'x' in column b to a number
+    '''
+    if result_index == -1:
+        row.append(0.0)
+    for index in additions:
+        try:
+            row[result_index] += float(row[index] or '0')
+        except (TypeError, ValueError):
+            raise(ValueError('could not convert %r in column %s to a number'
+                             % (row[index], header[index])))
+    for index in subtractions:
+        try:
+            row[result_index] -= float(row[index] or '0')
+        except (TypeError, ValueError):
+            raise(ValueError('could not convert %r in column %s to a number'
+                             % (row[index], header[index])))
+
+def process_chunks(reader, writer, additions, subtractions, header):
+    r'''
+    append the result column to each chunk of a columnar.Reader.
+
+    the sums are done in the same order as calculate_row, so give the same
+    floats. a chunk with short rows, or with a value that isn't a number,
+    goes row by row instead, for the same errors, after the same rows.
+
+    >>> from io import BytesIO
+    >>> outfile = BytesIO()
+    >>> writer = columnar.Writer(outfile)
+    >>> writer.writerows([['a', 'b'], ['1', '2'], ['', '4']])
+    >>> writer.flush()
+    >>> reader = csvio.reader(BytesIO(outfile.getvalue()))
+    >>> header = reader.next()
+    >>> process_chunks(reader, csvio.writer(), [0, 1], [], header + ['c'])
+    1,2,3.0
+    ,4,4.0
+    '''
+    for chunk in reader.chunks():
+        with stats.timed('parse'):
+            rows = chunk.rows()
+        try:
+            if chunk.ragged():
+                raise ValueError('short rows')
+            results = [0.0] * chunk.count
+            for index in additions:
+                results = map(add, results, chunk.floats(index))
+            for index in subtractions:
+                results = map(sub, results, chunk.floats(index))
+            for row, result in zip(rows, results):
+                row.append(result)
+        except ValueError:
+            if not by_row(rows, writer, additions, subtractions, header):
+                break
+            continue
+        try:
+            writer.writerows(rows)
+        except IOError:
+            logging.debug('apparently pipeline was shut down')
+            break
+
+def process_batches(reader, writer, additions, subtractions, header,
+                    size=BATCH):
+    r'''
+    append the result column to blocks of `size` rows at a time.
+
+    the sums are done in the same order as the row-by-row loop, so give
+    the same floats, and hence the same output. a block with a value that
+    isn't a number goes row by row instead, so the rows before it are
+    written before the error, as they are without --batch.
+
+    >>> import_numpy()
+    >>> from io import BytesIO
+    >>> reader = csvio.reader(BytesIO('1,2,\n4,,x\n6,0.5,8\n'))
+    >>> writer = csvio.writer()
+    >>> process_batches(reader, writer, [0, 1], [], ['a', 'b', 'c'], 2)
+    1,2,,3.0
+    4,,x,4.0
+    6,0.5,8,6.5
+    >>> reader = csvio.reader(BytesIO('1,2,\n4,,x\n6,0.5,8\n'))
+    >>> outfile = BytesIO()
+    >>> process_batches(reader, csvio.writer(outfile), [0], [2],
+    ...                 ['a', 'b', 'c'], 2)
+    Traceback (most recent call last):
+        ...
+    ValueError: could not convert 'x' in column c to a number
+    >>> outfile.getvalue()
+    '1,2,,1.0\n'
+    '''
+    while True:
+        block = list(islice(reader, size))
+        if not block:
+            break
+        result = numpy.zeros(len(block))
+        try:
+            for index in additions:
+                result += column(block, index)
+            for index in subtractions:
+                result -= column(block, index)
+        except ValueError:
+            if not by_row(block, writer, additions, subtractions, header):
+                break
+            continue
+        for row, value in zip(block, result.tolist()):
+            row.append(value)
+        try:
+            writer.writerows(block)
+        except IOError:
+            logging.debug('apparently pipeline was shut down')
+            break
+
+def import_numpy():
+    '''
+    import numpy, which takes a good part of a second, so is left until
+    --batch needs it
+    '''
+    global numpy
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError('--batch needs numpy')
+
+def by_row(rows, writer, additions, subtractions, header):
+    '''
+    calculate and write rows one at a time, for a block or chunk that
+    couldn't be done at once; False if the pipeline was shut down
+    '''
+    for row in rows:
+        calculate_row(row, -1, additions, subtractions, header)
+        try:
+            writer.writerow(row)
+        except IOError:
+            logging.debug('apparently pipeline was shut down')
+            return False
+    return True
+
+def column(block, index):
+    '''
+    float array of the given column of a block of rows, '' being 0.0
+    '''
+    return numpy.array([row[index] or '0' for row in block],
+                       dtype=numpy.float64)
+
+TOKEN = re.compile(r'''\s*(?:
+    \[(?P<column>[^\]]*)\] |
+    (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?) |
+    (?P<operator>[-+*/()])
+    )''', re.VERBOSE)
+
+def tokenize(expression):
+    '''
+    list of (kind, text) tokens of an expression
+
+    >>> tokenize('([*gross]-2.5e3)/ 4')
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [('operator', '('), ('column', '*gross'), ('operator', '-'),
+     ('number', '2.5e3'), ('operator', ')'), ('operator', '/'),
+     ('number', '4')]
+    '''
+    tokens, position = [], 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = TOKEN.match(expression, position)
+        if not match:
+            raise ValueError('cannot parse %r at %r' % (
+                expression, expression[position:]))
+        tokens.extend((kind, text) for kind, text in
+                      match.groupdict().items() if text is not None)
+        position = match.end()
+    return tokens
+
+def is_expressions(columns, header):
+    '''
+    whether the args are name=expression ones, rather than the names of
+    columns, which may have '=' in them too
+
+    >>> is_expressions(['c=[a] + [b]', ' d = [c]'], ['a', 'b'])
+    True
+    >>> is_expressions(['x', 'a=b', '-c'], ['a=b', 'c'])
+    False
+    >>> is_expressions(['x=y', '-a=b'], ['a=b'])
+    False
+    '''
+    names = [column[1:] if column.startswith('-') else column
+             for column in columns]
+    return bool(columns) and all('=' in column for column in columns) and \
+        not any(name in header for name in names + list(columns))
+
+def parse_expression(expression, names, safe=False):
+    '''
+    Python source for an expression, with columns as the names given by
+    names[column], so it can be used on floats or on NumPy arrays.
+
+    a simple recursive descent parser, so that precedence is the usual,
+    and anything but numbers, columns and the operators is rejected.
+
+    with `safe`, division is by `divide`, giving inf or nan for division
+    by zero as NumPy would, rather than raising ZeroDivisionError.
+
+    >>> parse_expression('-[a] * (2 + [b]) / [a]', {'a': 'c0', 'b': 'c1'})
+    '(((-c0) * (2.0 + c1)) / c0)'
+    >>> parse_expression('[a] / 2', {'a': 'c0'}, True)
+    'divide(c0, 2.0)'
+    '''
+    tokens = tokenize(expression)
+    tokens.reverse()
+
+    def peek():
+        if tokens and tokens[-1][0] == 'operator':
+            return tokens[-1][1]
+        return None
+
+    def expect(*allowed):
+        if not tokens:
+            raise ValueError('unexpected end of %r' % expression)
+        kind, text = tokens.pop()
+        if kind == 'operator' and text not in allowed:
+            raise ValueError('unexpected %r in %r' % (text, expression))
+        return kind, text
+
+    def parse_sum():
+        source = parse_product()
+        while peek() in ('+', '-'):
+            source = '(%s %s %s)' % (source, tokens.pop()[1], parse_product())
+        return source
+
+    def parse_product():
+        source = parse_factor()
+        while peek() in ('*', '/'):
+            operator = tokens.pop()[1]
+            if safe and operator == '/':
+                source = 'divide(%s, %s)' % (source, parse_factor())
+            else:
+                source = '(%s %s %s)' % (source, operator, parse_factor())
+        return source
+
+    def parse_factor():
+        kind, text = expect('(', '-', '+')
+        if kind == 'number':
+            return repr(float(text))
+        elif kind == 'column':
+            if not text in names:
+                raise ValueError('column %s not found in %s' % (
+                    text, sorted(names)))
+            return names[text]
+        elif text == '(':
+            source = parse_sum()
+            expect(')')
+            return source
+        return '(%s%s)' % (text, parse_factor())
+
+    source = parse_sum()
+    if tokens:
+        raise ValueError('unexpected %r in %r' % (tokens[-1][1], expression))
+    return source
+
+def compile_expressions(expressions, header, batch=False, safe=False):
+    r'''
+    compile name=expression strings into one function calculating them
+    all for a row (or, if `batch`, for a block of rows) in place.
+
+    the header is extended with the names of any new columns.
+
+    for a row, division by zero is retried with a `safe` function, using
+    `divide`, so that it gives inf or nan, as in batch mode, while the
+    usual case is no slower.
+
+    >>> header = ['id', '*gross', 'expenses']
+    >>> calculate = compile_expressions(['net=[*gross] - [expenses]',
+    ...     'expenses=[expenses] * 2', 'ratio=[net] / [*gross]'], header)
+    >>> header
+    ['id', '*gross', 'expenses', 'net', 'ratio']
+    >>> row = ['1', '100', '']
+    >>> calculate(row); row
+    ['1', '100', 0.0, 100.0, 1.0]
+    >>> row = ['2', '0', '']
+    >>> calculate(row); row
+    ['2', '0', 0.0, 0.0, nan]
+    '''
+    fallback = None
+    if not batch and not safe:
+        fallback = compile_expressions(expressions, list(header), safe=True)
+    names = dict((name, 'c%d' % index) for index, name in enumerate(header))
+    # on duplicate names, the first is used, as with header.index()
+    names.update((name, 'c%d' % header.index(name)) for name in header)
+    original = len(header)
+    used, lines, targets = set(), [], {}
+    for number, assignment in enumerate(expressions):
+        name, expression = split_assignment(assignment)
+        source = parse_expression(expression, names, safe)
+        used.update(int(word[1:]) for word in re.findall(r'\bc\d+\b', source))
+        if batch:
+            source = 'vector(%s, len(block))' % source
+        lines.append('    d%d = %s' % (number, source))
+        if not name in header:
+            header.append(name)
+        names[name] = targets[header.index(name)] = 'd%d' % number
+    if batch:
+        code = ['def calculate(block):']
+        code += ['    c%d = column(block, %d)' % (index, index)
+                 for index in sorted(used)]
+        code += lines
+        code.append('    for row, %s in zip(block, %s):' % (
+            ', '.join('v%d' % index for index in sorted(targets)),
+            ', '.join('%s.tolist()' % targets[index]
+                      for index in sorted(targets))))
+        indent, values = '        ', 'v%d'
+    else:
+        code = ['def calculate(row):']
+        code += ["    c%d = float(row[%d] or '0')" % (index, index)
+                 for index in sorted(used)]
+        code += lines
+        indent, values = '    ', None
+    for index in sorted(targets):
+        value = values % index if values else targets[index]
+        if index < original:
+            code.append('%srow[%d] = %s' % (indent, index, value))
+    if len(header) > original:
+        code.append('%srow.extend((%s,))' % (indent, ', '.join(
+            values % index if values else targets[index]
+            for index in range(original, len(header)))))
+    namespace = {'column': column, 'vector': vector, 'divide': divide}
+    exec '\n'.join(code) in namespace
+    calculate = namespace['calculate']
+    if batch:
+        return calculate
+
+    def checked(row):
+        '''
+        on a ValueError, say which cell was not a number, and on division
+        by zero, go by the fallback
+        '''
+        try:
+            calculate(row)
+        except ZeroDivisionError:
+            fallback(row)
+        except ValueError:
+            for index in sorted(used):
+                try:
+                    float(row[index] or '0')
+                except ValueError:
+                    raise(ValueError('could not convert %r in column %s'
+                                     ' to a number' % (row[index],
+                                                       header[index])))
+            raise
+    return checked
+
+def divide(numerator, denominator):
+    '''
+    numerator / denominator, or for a denominator of zero, the inf or nan
+    NumPy would give
+
+    >>> divide(1.0, 4.0), divide(-1.0, 0.0), divide(1.0, -0.0)
+    (0.25, -inf, -inf)
+    >>> divide(0.0, 0.0)
+    nan
+    '''
+    try:
+        return numerator / denominator
+    except ZeroDivisionError:
+        if numerator == 0 or numerator != numerator:
+            return float('nan')
+        return math.copysign(float('inf'), numerator) * \
+            math.copysign(1.0, denominator)
+
+def vector(value, length):
+    '''
+    value as an array, even if the expression had no columns in it
+    '''
+    if isinstance(value, numpy.ndarray):
+        return value
+    return numpy.full(length, value)
+
+def split_assignment(assignment):
+    '''
+    the name, stripped, and expression of a name=expression arg, or of a
+    (name, expression) pair, as made by as_expression
+
+    >>> split_assignment(' net = [a]'), split_assignment(('x=y', '[a]'))
+    (('net', ' [a]'), ('x=y', '[a]'))
+    '''
+    if isinstance(assignment, tuple):
+        return assignment
+    name, expression = assignment.split('=', 1)
+    return name.strip(), expression
+
+def as_expression(columns):
+    '''
+    the old `result column -column` arguments as a (name, expression) pair,
+    since the name may have '=' in it, adding to 0.0 first, so as to give
+    exactly the same floats.
+
+    >>> as_expression(['net', 'gross', '-expenses'])
+    ('net', '0 + [gross] - [expenses]')
+    '''
+    terms = ['0'] + ['- [%s]' % column[1:] if column.startswith('-')
+                     else '+ [%s]' % column for column in columns[1:]]
+    return columns[0], ' '.join(terms)
+
+def transform(rows, *columns):
+    '''
+    the calculation as a generator of rows, for pipeline.py, taking an
+    iterator of rows, header first, and the same args as process.
+
+    the results are made strings, as csv.writer would write them, so that
+    later stages see just what they would have in a shell pipeline.
+
+    >>> list(transform(iter([['a', 'b'], ['1', '2']]), 'c', 'a', '-b'))
+    [['a', 'b', 'c'], ['1', '2', '-1.0']]
+    '''
+    header = list(next(rows))
+    if not is_expressions(columns, header):
+        columns = [as_expression(list(columns))]
+    calculate = compile_expressions(columns, header)
+    results = sorted(set(header.index(split_assignment(column)[0])
+                         for column in columns))
+    yield header
+    for row in rows:
+        calculate(row)
+        for index in results:
+            row[index] = repr(row[index])
+        yield row
+
+def process_expressions(expressions, reader, writer, header, batch=None):
+    '''
+    add or replace each of the name=expression columns in the rows of
+    reader, whose header has been read.
+
+    with `batch`, a block with a value that isn't a number goes row by
+    row, so as to write the rows before it, and fail as without it.
+    '''
+    if batch:
+        import_numpy()
+        # for a block with a value that isn't a number
+        calculate_row = compile_expressions(expressions, list(header))
+    calculate = compile_expressions(expressions, header, bool(batch))
+    writer.writerow(header)
+    try:
+        if batch:
+            size = BATCH if batch is True else int(batch)
+            while True:
+                block = list(islice(reader, size))
+                if not block:
+                    break
+                try:
+                    calculate(block)
+                except ValueError:
+                    for row in block:
+                        calculate_row(row)
+                        writer.writerow(row)
+                    continue
+                writer.writerows(block)
+        else:
+            for row in reader:
+                calculate(row)
+                writer.writerow(row)
+    except IOError:
+        logging.debug('apparently pipeline was shut down')
+
 if __name__ == '__main__':
-    process(sys.argv[1:])
+    ARGS = [arg for arg in sys.argv[1:] if not arg.startswith('--batch')]
+    OPTIONS = dict((arg[2:].split('=', 1) + [True])[:2]
+                   for arg in sys.argv[1:] if arg.startswith('--batch'))
+    process(ARGS, **OPTIONS)
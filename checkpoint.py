@@ -0,0 +1,356 @@
+'''
+checkpointed output, so that a long run that dies can be resumed.
+
+with --checkpoint=DIRECTORY, left_outer_join.py and deduplicate.py write
+their output not to stdout but to numbered part files in DIRECTORY,
+part-00000.csv, part-00001.csv and so on, each with the header, as Spark
+would write them, so removeheaders.py can put them back together; the
+files it keeps for itself start with '_', so that it skips them. a part
+is finished once it holds --partsize bytes of CSV (256M by default), at
+the end of a chunk of input, and only then renamed from its hidden name and
+recorded in DIRECTORY/_checkpoint.json, with the offset in the input, after
+the header, up to which it covers. any state the filter needs to go on
+from there, such as deduplicate's counts, is saved along with it, as the
+changes since the part before, so that each part's state is only as big
+as the changes in it, and a rerun replays them all in order; and
+anything expensive to rebuild, such as left_outer_join's right-hand dict,
+saved once, so that it needn't be built again.
+
+run again with the same args and the same input, a filter skips the parts
+already finished, seeking to or, on a pipe, reading past, the offset of the
+last of them, and goes on from there. once all is done, another run does
+nothing but any uploads left to do.
+
+with --upload=COMMAND, each part is uploaded as soon as it is finished,
+by running COMMAND with {} replaced by the part's path, or with the path
+appended if there is no {}, e.g. --upload='aws s3 cp {} s3://bucket/out/'.
+--uploads=N of them (4 by default) run at once, while the filter goes on
+writing. parts are recorded as uploaded when COMMAND succeeds.
+
+parts are compressed if $COMPRESS is set, and named .csv.gz and so on.
+'''
+from __future__ import print_function
+import sys, os, json, marshal, shlex, subprocess, threading, logging
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+import csvio, columnar
+PARTSIZE = 256 * 1024 * 1024
+UPLOADS = 4
+MANIFEST = '_checkpoint.json'
+# items of a dict marshalled at a time by dump_dict
+BATCH = 1024
+
+class Checkpoint(object):
+    r'''
+    the part files and manifest in directory, resumed from where the last
+    run left off, if there was one. call `start` with the header before
+    writing to it.
+
+    >>> import tempfile, shutil
+    >>> directory = tempfile.mkdtemp()
+    >>> checkpoint = Checkpoint(directory, 4)
+    >>> checkpoint.start(['a\xe9'])
+    >>> checkpoint.write('1\n'); checkpoint.advance(3, lambda: 'x')
+    False
+    >>> checkpoint.write('22\n'); checkpoint.advance(3, lambda: 'y')
+    True
+    >>> checkpoint.write('3\n'); checkpoint.advance(2)
+    False
+    >>> sorted(os.listdir(directory))
+    ['.part-00001.csv', '_checkpoint.json', '_state-00000', 'part-00000.csv']
+    >>> resumed = Checkpoint(directory, 4)
+    >>> resumed.offset, list(resumed.states()), len(resumed.parts)
+    (6, ['y'], 1)
+    >>> resumed.start(['b'])
+    Traceback (most recent call last):
+        ...
+    ValueError: checkpoint has header ['a\xe9'], not ['b']
+    >>> resumed.start(['a\xe9']); resumed.finish()
+    >>> open(os.path.join(directory, 'part-00000.csv')).read()
+    'a\xe9\n1\n22\n'
+    >>> Checkpoint(directory).done
+    True
+    >>> shutil.rmtree(directory)
+    '''
+    def __init__(self, directory, partsize=PARTSIZE, upload=None,
+                 uploads=UPLOADS):
+        self.directory, self.header = directory, None
+        self.partsize, self.upload = int(partsize), upload
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # held while changing or writing out the manifest
+        self.lock = threading.RLock()
+        self.manifest = {'header': None, 'parts': [], 'uploaded': [],
+                         'saved': {}, 'offset': 0, 'done': False}
+        if os.path.exists(self.path(MANIFEST)):
+            with open(self.path(MANIFEST)) as infile:
+                self.manifest = json.load(infile)
+            logging.info('resuming after %d parts, at input offset %d',
+                         len(self.parts), self.offset)
+        self.suffix = '.csv'
+        if os.environ.get('COMPRESS'):
+            self.suffix += '.' + os.environ['COMPRESS']
+        self.part, self.size, self.pending = None, 0, 0
+        self.pool, self.failed = None, []
+        if upload:
+            self.pool = ThreadPool(int(uploads))
+            for name in self.parts:
+                if not name in self.manifest['uploaded']:
+                    self.send(name)
+
+    @property
+    def parts(self):
+        return self.manifest['parts']
+
+    @property
+    def offset(self):
+        return self.manifest['offset']
+
+    @property
+    def done(self):
+        return self.manifest['done']
+
+    def start(self, header):
+        '''
+        set the header of the parts, which must be the same as before, if
+        this is a rerun
+        '''
+        # kept as latin-1, which any bytes decode as, since JSON needs text
+        decoded = [field.decode('latin-1') for field in header]
+        if self.parts and self.manifest['header'] != decoded:
+            raise ValueError('checkpoint has header %s, not %s' % (
+                [field.encode('latin-1')
+                 for field in self.manifest['header']], header))
+        self.header, self.manifest['header'] = header, decoded
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def state_name(self, number):
+        return '_state-%05d' % number
+
+    def states(self):
+        '''
+        the states saved with the parts so far, in order, each being the
+        changes since the one before
+        '''
+        for number in range(len(self.parts)):
+            state = self.load(self.state_name(number), number)
+            if state is not None:
+                yield state
+
+    def commit(self):
+        '''
+        write out the manifest, atomically
+        '''
+        with self.lock:
+            temporary = self.path(MANIFEST + '.tmp')
+            with open(temporary, 'w') as outfile:
+                json.dump(self.manifest, outfile, indent=1)
+            os.rename(temporary, self.path(MANIFEST))
+
+    def save(self, name, value, stamp=None, commit=True, dump=None):
+        '''
+        save value as `name`, to be loaded only with the same stamp, by
+        dump(value, outfile), or if not given, marshal, which can't save
+        strings of 2G or more
+        '''
+        stamp = json.loads(json.dumps(stamp))
+        temporary = self.path(name + '.tmp')
+        with open(temporary, 'wb') as outfile:
+            marshal.dump(stamp, outfile, 2)
+            if dump is None:
+                marshal.dump(value, outfile, 2)
+            else:
+                dump(value, outfile)
+        os.rename(temporary, self.path(name))
+        self.manifest['saved'][name] = stamp
+        if commit:
+            self.commit()
+
+    def load(self, name, stamp=None, load=marshal.load):
+        '''
+        value saved as `name` with the same stamp, read by load(infile),
+        else None
+        '''
+        stamp = json.loads(json.dumps(stamp))
+        if (not name in self.manifest['saved'] or
+                self.manifest['saved'][name] != stamp or
+                not os.path.exists(self.path(name))):
+            return None
+        with open(self.path(name), 'rb') as infile:
+            if marshal.load(infile) != stamp:
+                return None
+            return load(infile)
+
+    def chunks(self, infile):
+        '''
+        (chunk, number of bytes of infile) for each chunk of records of
+        infile from the checkpoint's offset on
+        '''
+        magic = len(columnar.MAGIC) if csvio.is_columnar(infile) else 0
+        skip(infile, self.offset)
+        for chunk in csvio.chunk_records(infile):
+            yield chunk, len(chunk) - magic
+
+    def write(self, text):
+        '''
+        add CSV text to the current part
+        '''
+        if self.part is None:
+            self.part = csvio.open_file(self.path(
+                '.part-%05d%s' % (len(self.parts), self.suffix)), 'wb')
+            csvio.Writer(self.part).writerow(self.header)
+        self.part.write(text)
+        self.size += len(text)
+
+    def advance(self, size, state=None):
+        '''
+        record that the text written so far covers another `size` bytes of
+        input, finishing the part if it is big enough, and saving with it
+        state(), if given, which should be the changes since the last part;
+        True if it did finish one
+        '''
+        self.pending += size
+        if self.size >= self.partsize:
+            self.finish_part(state)
+            return True
+        return False
+
+    def finish_part(self, state=None):
+        '''
+        rename the current part, and record it and its offset
+        '''
+        number = len(self.parts)
+        if self.part is None:
+            self.write('')
+        self.part.close()
+        name = 'part-%05d%s' % (number, self.suffix)
+        os.rename(self.path('.' + name), self.path(name))
+        with self.lock:
+            if state is not None:
+                self.save(self.state_name(number), state(), number, False)
+            self.manifest['offset'] += self.pending
+            self.parts.append(name)
+            self.commit()
+        self.part, self.size, self.pending = None, 0, 0
+        if self.upload:
+            self.send(name)
+
+    def finish(self, state=None):
+        '''
+        finish the last part, even if empty, if there are no others, and
+        wait for any uploads
+        '''
+        if not self.done:
+            if self.part is not None or not self.parts:
+                self.finish_part(state)
+            with self.lock:
+                self.manifest['done'] = True
+                self.commit()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            if self.failed:
+                raise IOError('failed to upload %s' % ', '.join(self.failed))
+
+    def send(self, name):
+        '''
+        start uploading the part `name`
+        '''
+        command = [self.path(name) if word == '{}' else word
+                   for word in shlex.split(self.upload)]
+        if not '{}' in shlex.split(self.upload):
+            command.append(self.path(name))
+        self.pool.apply_async(run, (command,),
+                              callback=lambda status: self.sent(name, status))
+
+    def sent(self, name, status):
+        if status:
+            logging.error('upload of %s failed with status %s', name, status)
+            self.failed.append(name)
+            return
+        with self.lock:
+            self.manifest['uploaded'].append(name)
+            self.commit()
+
+def dump_dict(mapping, outfile):
+    '''
+    write a dict, or defaultdict, to outfile with marshal, a batch of
+    items at a time, so that no copy is made of the whole of it
+
+    >>> import tempfile
+    >>> saved = tempfile.TemporaryFile()
+    >>> dump_dict(dict.fromkeys(range(2 * BATCH), 1), saved); saved.seek(0)
+    >>> len(load_dict(saved))
+    2048
+    '''
+    items = mapping.iteritems()
+    while True:
+        batch = dict(islice(items, BATCH))
+        marshal.dump(batch, outfile, 2)
+        if not batch:
+            break
+
+def load_dict(infile):
+    '''
+    a dict read from infile, as written by dump_dict
+    '''
+    mapping = {}
+    while True:
+        batch = marshal.load(infile)
+        if not batch:
+            return mapping
+        mapping.update(batch)
+
+def run(command):
+    '''
+    exit status of command, or 127 if it couldn't be run
+    '''
+    try:
+        return subprocess.call(command)
+    except OSError as failed:
+        logging.error('cannot run %s: %s', command, failed)
+        return 127
+
+def skip(infile, offset):
+    '''
+    move infile on by offset bytes, by seeking if it can, else reading
+
+    >>> from io import BytesIO
+    >>> infile = BytesIO('abcdef')
+    >>> infile.read(1); skip(infile, 2); infile.read()
+    'a'
+    'def'
+    '''
+    if not offset:
+        return
+    try:
+        infile.seek(offset, os.SEEK_CUR)
+        return
+    except (IOError, AttributeError, ValueError):
+        pass
+    while offset:
+        block = infile.read(min(offset, csvio.BUFSIZE))
+        if not block:
+            raise ValueError('input ended before checkpoint offset')
+        offset -= len(block)
+
+def options(options):
+    '''
+    pop the checkpoint options from a filter's dict of options, returning
+    a dict of the args for Checkpoint other than the header, or None
+
+    >>> sorted(options({'checkpoint': '/tmp/x'}).items())
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [('directory', '/tmp/x'), ('partsize', 268435456), ('upload', None),
+     ('uploads', 4)]
+    >>> options({'partsize': '1M'}) is None
+    True
+    '''
+    settings = dict(directory=options.pop('checkpoint', None),
+                    partsize=csvio.parse_size(options.pop('partsize',
+                                                          PARTSIZE)),
+                    upload=options.pop('upload', None),
+                    uploads=int(options.pop('uploads', UPLOADS)))
+    return settings if settings['directory'] else None
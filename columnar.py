@@ -0,0 +1,396 @@
+#!/usr/bin/python -OO
+'''
+columnar binary format for the intermediate files between the filters.
+
+a file is the MAGIC string followed by chunks of rows, each chunk a
+header of its size in bytes, its number of rows, and its number of
+columns, followed by the columns one after the other. the first row, the
+header of the CSV, is always a chunk of its own, so that its names don't
+spoil the types of the columns below it, and so that it can be read
+without reading any further.
+
+each column of a chunk in which at most half the values are distinct is
+stored as strings, dictionary-encoded: the distinct values, separated by
+NULs, which CSV can't have, then a code for each row, of 1, 2 or 4 bytes
+depending on how many distinct values there are. any other column is stored
+as the first of these that fits all its non-empty values exactly, such that
+they come back as the same strings, else as strings after all:
+    'q': 64-bit integers
+    'd': 64-bit floats, whose repr is the original string
+numeric columns with empty values have a byte mask of which are empty.
+a filter wanting numbers, such as calculate.py, can take a column of a
+chunk at a time as floats, parsing each distinct string only once.
+if the rows of a chunk are of different lengths, their lengths come
+before the columns, and the missing values are stored as empty.
+
+columnar files can be concatenated like CSV ones, with cat: a MAGIC where
+a chunk should start is skipped.
+
+a regular file is read with mmap. csvio recognizes the format by its
+MAGIC, so every filter reads it in place of CSV; and writes it with
+$FORMAT=columnar, or to files opened with csvio.open_file whose names end
+in .col (or .col.gz and so on).
+
+as a filter, converts CSV to the columnar format, or with --csv, back.
+'''
+from __future__ import print_function
+import sys, os, struct, mmap
+from itertools import izip
+import stats
+MAGIC = 'CSVCOL1\n'
+# chunk size, number of rows, number of columns
+CHUNK = struct.Struct('<III')
+# rows in each chunk but the first
+CHUNKROWS = 65536
+# the largest value code that fits each size of code
+CODES = [(0xff, 'B'), (0xffff, 'H'), (0xffffffff, 'I')]
+
+def process(csv=False):
+    '''
+    convert CSV on stdin to columnar on stdout, or with --csv, back
+    '''
+    import csvio  # not at the top, since csvio imports this module
+    reader = csvio.reader()
+    writer = csvio.writer(csvio.stdout('csv' if csv else 'columnar'))
+    writer.writerows(reader)
+
+def pack(values, typecode):
+    '''
+    values as little-endian typecode
+
+    >>> pack([1, -1], 'q') == '\\x01' + '\\x00' * 7 + '\\xff' * 8
+    True
+    '''
+    return struct.pack('<%d%s' % (len(values), typecode), *values)
+
+def unpack(data, offset, count, typecode):
+    '''
+    tuple of count little-endian values of typecode at offset in data,
+    and the offset after them
+    '''
+    layout = struct.Struct('<%d%s' % (count, typecode))
+    return layout.unpack_from(data, offset), offset + layout.size
+
+def text(value):
+    '''
+    value as csv.writer would write it
+    '''
+    if value is None:
+        return ''
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def encode(rows):
+    r'''
+    a chunk of rows, as a string
+
+    >>> rows = [['1', 'a', '2.5'], ['', 'b', '-1e+100'], ['3', 'a']]
+    >>> Chunk(encode(rows)).rows() == rows
+    True
+    '''
+    lengths = map(len, rows)
+    width = max(lengths) if rows else 0
+    ragged = lengths.count(width) != len(rows)
+    if ragged:
+        padding = [''] * width
+        rows = [row + padding[len(row):] for row in rows]
+    parts = [chr(ragged)]
+    if ragged:
+        parts.append(pack(lengths, 'I'))
+    for values in izip(*rows):
+        values = list(values)
+        try:
+            ''.join(values)
+        except TypeError:
+            values = map(text, values)
+        parts.extend(encode_column(values))
+    body = ''.join(parts)
+    return CHUNK.pack(len(body), len(rows), width) + body
+
+def encode_column(values):
+    '''
+    list of strings making up the encoded column of values
+
+    >>> encode_column(['1', '', '-3'])[:2]
+    ['q', '\\x01']
+    >>> encode_column(['1.5', '2.0'])[0], encode_column(['1', '01'])[0]
+    ('d', 's')
+    >>> encode_column(['1', '2', '1', '1'])[0]
+    's'
+    '''
+    codes = {}
+    indexes = [codes.setdefault(value, len(codes)) for value in values]
+    if 2 * len(codes) > len(values):
+        encoded = encode_numbers(values)
+        if encoded:
+            return encoded
+    words = sorted(codes, key=codes.get)
+    size = next(code for limit, code in CODES if len(words) <= limit + 1)
+    joined = '\x00'.join(words)
+    if joined.count('\x00') > max(len(words) - 1, 0):
+        raise ValueError('NUL byte in value, as the csv module refuses')
+    return ['s', size, pack([len(words), len(joined)], 'I'), joined,
+            pack(indexes, size)]
+
+def encode_numbers(values):
+    '''
+    list of strings making up the encoded column of numbers, or None if
+    they aren't all numbers that come back as the same strings
+    '''
+    present = [value for value in values if value] if '' in values else values
+    for typecode, parse, format in (('q', int, str), ('d', float, repr)):
+        try:
+            numbers = map(parse, present)
+            if map(format, numbers) != present:
+                continue
+            if len(present) == len(values):
+                return [typecode, '\x00', pack(numbers, typecode)]
+            numbers = iter(numbers)
+            mask = ''.join('\x01' if value else '\x00' for value in values)
+            return [typecode, '\x01', mask,
+                    pack([next(numbers) if value else 0 for value in values],
+                         typecode)]
+        except (ValueError, OverflowError, struct.error):
+            continue
+    return None
+
+class Chunk(object):
+    r'''
+    the chunk at offset in data, whose columns are decoded only as they
+    are needed: as strings, or as floats, for which only the distinct
+    values of a string column are parsed.
+
+    >>> chunk = Chunk(encode([['1', 'a', '2.5'], ['', 'b', 'x'], ['3', 'a']]))
+    >>> chunk.rows()
+    [['1', 'a', '2.5'], ['', 'b', 'x'], ['3', 'a']]
+    >>> chunk.values(0), chunk.floats(0), chunk.ragged()
+    (['1', '', '3'], [1.0, 0.0, 3.0], True)
+    >>> Chunk(encode([[], ['']])).rows()
+    [[], ['']]
+    '''
+    def __init__(self, data, offset=0):
+        self.data = data
+        size, self.count, self.width = CHUNK.unpack_from(data, offset)
+        offset += CHUNK.size
+        self.end = offset + size
+        self.lengths = None
+        if data[offset] == '\x01':
+            self.lengths, offset = unpack(data, offset + 1, self.count, 'I')
+        else:
+            offset += 1
+        # typecode, flag and offset of each column
+        self.columns = []
+        for column in range(self.width):
+            typecode, flag = data[offset], data[offset + 1]
+            self.columns.append((typecode, flag, offset + 2))
+            offset += 2
+            if typecode == 's':
+                length = unpack(data, offset, 2, 'I')[0][1]
+                offset += 8 + length + struct.calcsize(flag) * self.count
+            else:
+                offset += self.count * (9 if flag == '\x01' else 8)
+
+    def ragged(self):
+        '''
+        whether the rows are of different lengths
+        '''
+        return self.lengths is not None
+
+    def strings(self, index):
+        '''
+        the distinct values of a string column, and the code of each row's
+        '''
+        size, offset = self.columns[index][1:]
+        (words, length), offset = unpack(self.data, offset, 2, 'I')
+        strings = self.data[offset:offset + length].split('\x00')
+        return (strings if words else []), unpack(
+            self.data, offset + length, self.count, size)[0]
+
+    def numbers(self, index):
+        '''
+        the numbers of a numeric column, 0 where empty, and the mask of
+        which are not empty, if any are
+        '''
+        typecode, flag, offset = self.columns[index]
+        mask = None
+        if flag == '\x01':
+            mask = self.data[offset:offset + self.count]
+            offset += self.count
+        return unpack(self.data, offset, self.count, typecode)[0], mask
+
+    def values(self, index):
+        '''
+        the column as strings
+        '''
+        typecode = self.columns[index][0]
+        if typecode == 's':
+            strings, codes = self.strings(index)
+            return map(strings.__getitem__, codes)
+        numbers, mask = self.numbers(index)
+        values = map(str if typecode == 'q' else repr, numbers)
+        if mask is not None:
+            values = [value if present == '\x01' else ''
+                      for value, present in izip(values, mask)]
+        return values
+
+    def floats(self, index):
+        '''
+        the column as floats, empty values being 0.0. a ValueError is
+        raised if any other value isn't a number.
+        '''
+        if self.columns[index][0] == 's':
+            strings, codes = self.strings(index)
+            table = [float(string or '0') for string in strings]
+            return map(table.__getitem__, codes)
+        return map(float, self.numbers(index)[0])
+
+    def rows(self):
+        '''
+        the rows, as lists of strings
+        '''
+        if not self.width:
+            return [[] for row in range(self.count)]
+        rows = map(list, izip(*map(self.values, range(self.width))))
+        if self.lengths is not None:
+            rows = [row[:length] for row, length in izip(rows, self.lengths)]
+        return rows
+
+def chunks(infile):
+    '''
+    the chunks of infile, positioned after its MAGIC, each a string
+    '''
+    while True:
+        header = infile.read(CHUNK.size)
+        if header.startswith(MAGIC):
+            header = header[len(MAGIC):] + infile.read(len(MAGIC))
+        if not header:
+            break
+        if len(header) < CHUNK.size:
+            raise ValueError('truncated columnar chunk header')
+        body = infile.read(CHUNK.unpack(header)[0])
+        yield header + body
+
+class Reader(object):
+    '''
+    iterator of the rows of infile, positioned after its MAGIC, whose
+    remaining chunks can also be had whole, with `chunks`.
+
+    a regular file is read with mmap, its position kept in step, so that
+    another reader can take up where this one left off.
+
+    >>> from io import BytesIO
+    >>> outfile = BytesIO()
+    >>> writer = Writer(outfile)
+    >>> writer.writerows([['a', 'b'], ['1', 'x'], ['2', 'y']])
+    >>> writer.flush()
+    >>> reader = Reader(BytesIO(outfile.getvalue()[len(MAGIC):]))
+    >>> reader.next()
+    ['a', 'b']
+    >>> [chunk.values(1) for chunk in reader.chunks()]
+    [['x', 'y']]
+    >>> list(Reader(BytesIO(outfile.getvalue()[len(MAGIC):] * 2)))[2:4]
+    [['2', 'y'], ['a', 'b']]
+    '''
+    def __init__(self, infile):
+        self.infile = infile
+        try:
+            self.mapped = mmap.mmap(infile.fileno(), 0,
+                                    access=mmap.ACCESS_READ)
+        except (AttributeError, EnvironmentError, ValueError):
+            self.mapped = None
+            self.raw = chunks(infile)
+        self.rows = iter([])
+        self.iterator = self.generate()
+
+    def __iter__(self):
+        return self.iterator
+
+    def next(self):
+        return next(self.iterator)
+
+    def generate(self):
+        '''
+        the rows of each chunk in turn
+        '''
+        while True:
+            for row in self.rows:
+                yield row
+            with stats.timed('parse'):
+                chunk = self.chunk()
+                if chunk is None:
+                    return
+                self.rows = iter(chunk.rows())
+
+    def chunk(self):
+        '''
+        the next chunk, or None at the end
+        '''
+        if self.mapped is None:
+            data = next(self.raw, None)
+            if data is None:
+                return None
+            chunk = Chunk(data)
+        else:
+            offset = self.infile.tell()
+            if self.mapped[offset:offset + len(MAGIC)] == MAGIC:
+                offset += len(MAGIC)
+            if offset >= len(self.mapped):
+                return None
+            chunk = Chunk(buffer(self.mapped), offset)
+            self.infile.seek(chunk.end)
+        stats.count(chunk.count)
+        return chunk
+
+    def chunks(self):
+        '''
+        the rest of the chunks, starting with any rows not yet read
+        '''
+        rest = list(self.rows)
+        if rest:
+            yield Chunk(encode(rest))
+        while True:
+            chunk = self.chunk()
+            if chunk is None:
+                return
+            yield chunk
+
+class Writer(object):
+    '''
+    writes rows to outfile in the columnar format, a chunk at a time.
+    call flush, or close, after the last of them.
+    '''
+    def __init__(self, outfile, chunkrows=CHUNKROWS):
+        self.outfile, self.chunkrows = outfile, chunkrows
+        self.outfile.write(MAGIC)
+        self.rows, self.limit = [], 1
+
+    def writerow(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.limit:
+            self.flush()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.rows.append(row)
+            if len(self.rows) >= self.limit:
+                self.flush()
+
+    def flush(self):
+        '''
+        write out the rows so far as a chunk
+        '''
+        if self.rows:
+            self.outfile.write(encode(self.rows))
+            self.rows, self.limit = [], self.chunkrows
+        self.outfile.flush()
+
+    def close(self):
+        self.flush()
+        self.outfile.close()
+
+if __name__ == '__main__':
+    ARGS = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    OPTIONS = dict((arg[2:].split('=', 1) + [True])[:2]
+                   for arg in sys.argv[1:] if arg.startswith('--'))
+    process(*ARGS, **OPTIONS)
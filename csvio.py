@@ -0,0 +1,613 @@
+'''
+faster CSV reading and writing, shared by all the filters.
+
+stdin and stdout are reopened as binary files with big buffers. records
+are read, and single rows written, by the csv module itself, whose C code
+is faster per row than anything done in Python. rows written together
+are joined with commas a batch at a time, unless some field needs
+quoting, or isn't a string, in which case csv.writer writes that batch.
+
+either way, the rows read and the bytes written are the same as those of
+csv.reader and csv.writer(lineterminator='\\n').
+
+gzip, bzip2 and xz input is decompressed on the fly, whether it comes on
+stdin or from a file opened with open_file; it is recognized by its magic
+number. files opened with open_file for writing are compressed according
+to their extension, as is stdout if $COMPRESS is gz, bz2 or xz. output is
+compressed in independent blocks, each a complete gzip member or bzip2 or
+xz stream, in a pool of threads, $COMPRESS_THREADS of them or one per
+core, so that it isn't limited to the speed of a single core.
+
+input in the columnar format of columnar.py is recognized by its MAGIC,
+and read in place of CSV; stdout is written in it with $FORMAT=columnar,
+as are files opened with open_file whose names end in .col, before any
+compression extension. text written to these is parsed as CSV first.
+
+with $STATS set, the rows read and written, and the time taken parsing
+and writing them, are counted, and reported as described in stats.py.
+'''
+from __future__ import print_function
+import sys, os, io, csv, errno, atexit, logging, zlib, bz2, multiprocessing
+from itertools import chain, islice
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from weakref import WeakSet
+import columnar, stats
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+BUFSIZE = 1024 * 1024
+# size of the blocks compressed independently, each by a thread
+BLOCKSIZE = 1024 * 1024
+# approximate size in bytes of the chunks made by chunk_records
+CHUNKSIZE = 1024 * 1024
+# rows joined before writing them out together
+BATCH = 1024
+# line parsed after each batch, to see whether it ended with a record
+END = 'END'
+# the original sys.stdin and sys.stdout, and the files reopened from them
+STREAMS = {}
+# files known to be columnar, past their MAGIC
+COLUMNAR = WeakSet()
+
+def reopen(stream, mode, compression=None, format=None):
+    '''
+    the same file as stream, but binary, and with a BUFSIZE buffer;
+    decompressed if it is compressed input, and compressed with
+    `compression` if given, and in the columnar format if `format` is
+    'columnar', for output.
+
+    the same file object is returned each time, so that nothing read
+    ahead is lost. streams without a file descriptor, such as BytesIO or
+    doctest's stdout, are returned as they are.
+    '''
+    if stream in STREAMS:
+        return STREAMS[stream]
+    try:
+        descriptor = os.dup(stream.fileno())
+    except (AttributeError, IOError, OSError, ValueError):
+        return stream
+    if mode.startswith('w'):
+        stream.flush()
+        reopened = os.fdopen(descriptor, mode, BUFSIZE)
+        if compression:
+            reopened = Compressed(reopened, compression)
+        if format == 'columnar':
+            reopened = ColumnarText(reopened)
+        atexit.register(close, reopened)
+    else:
+        reopened = decompressed(io.open(descriptor, mode, buffering=BUFSIZE))
+    STREAMS[stream] = reopened
+    return reopened
+
+def stdin():
+    '''
+    big-buffered binary sys.stdin
+    '''
+    return reopen(sys.stdin, 'rb')
+
+def stdout(format=None):
+    '''
+    big-buffered binary sys.stdout, flushed at exit, compressed if
+    $COMPRESS is set, and columnar if format, or else $FORMAT, is
+    'columnar'. the first call decides.
+    '''
+    return reopen(sys.stdout, 'wb', os.environ.get('COMPRESS'),
+                  format or os.environ.get('FORMAT'))
+
+def open_file(filename, mode='rb'):
+    '''
+    open filename, decompressing it if compressed, or for writing,
+    compressing it if its name ends in .gz, .bz2 or .xz, and writing the
+    columnar format if it ends in .col, less any of those.
+    '''
+    if mode.startswith('w'):
+        base, extension = os.path.splitext(filename)
+        outfile = io.open(filename, mode, buffering=BUFSIZE)
+        if extension[1:] in COMPRESSORS:
+            outfile = Compressed(outfile, extension[1:])
+            extension = os.path.splitext(base)[1]
+        if extension == '.col':
+            outfile = ColumnarText(outfile)
+        return outfile
+    return decompressed(io.open(filename, mode, buffering=BUFSIZE))
+
+def close(outfile):
+    '''
+    flush and close outfile, ignoring a broken pipe.
+
+    this runs at exit, where an exception would only be printed, leaving
+    the exit status 0, so any other error, such as one from compressing
+    the last blocks, is logged and the process exits with status 1.
+    '''
+    try:
+        outfile.close()
+    except Exception as failed:
+        if isinstance(failed, IOError) and failed.errno == errno.EPIPE:
+            return
+        logging.exception('could not close %s', outfile)
+        os._exit(1)
+
+def gzip_compress(data, level=6):
+    r'''
+    data as a complete gzip member
+
+    >>> import gzip
+    >>> from io import BytesIO
+    >>> gzip.GzipFile(fileobj=BytesIO(gzip_compress('a,b\n'))).read()
+    'a,b\n'
+    '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def gzip_decompressor():
+    '''
+    decompressor for a single gzip member
+    '''
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+def xz_compress(data):
+    '''
+    data as a complete xz stream
+    '''
+    if lzma is None:
+        raise ImportError('xz needs the lzma module (backports.lzma)')
+    return lzma.compress(data)
+
+def xz_decompressor():
+    '''
+    decompressor for a single xz stream
+    '''
+    if lzma is None:
+        raise ImportError('xz needs the lzma module (backports.lzma)')
+    return lzma.LZMADecompressor()
+
+# compression by extension, or $COMPRESS, of independent blocks
+COMPRESSORS = {'gz': gzip_compress, 'bz2': bz2.compress, 'xz': xz_compress}
+# decompressor factories by magic number
+DECOMPRESSORS = {'\x1f\x8b': gzip_decompressor, 'BZh': bz2.BZ2Decompressor,
+                 '\xfd7zXZ\x00': xz_decompressor}
+
+def decompressed(infile):
+    r'''
+    infile, a buffered binary file, decompressed if it starts with the
+    magic number of one of the DECOMPRESSORS
+
+    >>> from io import BufferedReader, BytesIO
+    >>> data = BytesIO(gzip_compress('a,b\n') + gzip_compress('1,2\n'))
+    >>> decompressed(BufferedReader(data)).readlines()
+    ['a,b\n', '1,2\n']
+    >>> decompressed(BufferedReader(BytesIO(bz2.compress('a,b\n')))).read()
+    'a,b\n'
+    >>> decompressed(BufferedReader(BytesIO('a,b\n'))).read()
+    'a,b\n'
+    '''
+    start = infile.peek(6)
+    for magic, decompressor in DECOMPRESSORS.items():
+        if start.startswith(magic):
+            return io.BufferedReader(Decompressed(infile, decompressor),
+                                     BUFSIZE)
+    return infile
+
+def is_compressed(filename):
+    '''
+    whether the file starts with the magic number of one of the
+    DECOMPRESSORS
+
+    >>> is_compressed(os.devnull)
+    False
+    '''
+    with open(filename, 'rb') as infile:
+        start = infile.read(6)
+    return any(start.startswith(magic) for magic in DECOMPRESSORS)
+
+class Decompressed(io.RawIOBase):
+    r'''
+    raw file of the data decompressed from infile. when one stream, or
+    gzip member, ends, another decompressor starts on what follows it,
+    even if that is at the start of the next read.
+
+    >>> class Reads(object):
+    ...     def __init__(self, reads):
+    ...         self.reads = reads
+    ...     def read(self, size):
+    ...         return self.reads.pop(0) if self.reads else ''
+    >>> streams = Reads([bz2.compress('a\n'), bz2.compress('b\n')])
+    >>> io.BufferedReader(Decompressed(streams, bz2.BZ2Decompressor)).read()
+    'a\nb\n'
+    '''
+    def __init__(self, infile, decompressor):
+        super(Decompressed, self).__init__()
+        self.infile, self.decompressor = infile, decompressor
+        self.current = decompressor()
+        self.pending = ''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending:
+            data = self.infile.read(BUFSIZE)
+            if not data:
+                return 0
+            while data:
+                try:
+                    self.pending += self.current.decompress(data)
+                except EOFError:
+                    # bz2 and xz streams that ended with the last read
+                    self.current = self.decompressor()
+                    continue
+                data = self.current.unused_data
+                if data:
+                    self.current = self.decompressor()
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+    def close(self):
+        self.infile.close()
+        super(Decompressed, self).close()
+
+class Compressed(io.RawIOBase):
+    r'''
+    file object compressing what is written to it into outfile.
+
+    it is cut into BLOCKSIZE blocks compressed independently in a pool of
+    threads, since zlib, bz2 and lzma release the GIL while they work;
+    up to twice as many blocks as there are threads are queued, and the
+    compressed blocks are written in order.
+
+    >>> import tempfile
+    >>> filename = tempfile.mkstemp(suffix='.csv.gz')[1]
+    >>> compressed = open_file(filename, 'wb')
+    >>> compressed.blocksize = 3
+    >>> compressed.write('a,b\n1,2\n3,4\n')
+    12
+    >>> compressed.close()
+    >>> open(filename, 'rb').read().count('\x1f\x8b')
+    4
+    >>> open_file(filename).readlines()
+    ['a,b\n', '1,2\n', '3,4\n']
+    >>> os.remove(filename)
+    '''
+    def __init__(self, outfile, compression, threads=None):
+        super(Compressed, self).__init__()
+        if compression not in COMPRESSORS:
+            raise ValueError('unknown compression %r, not one of %s'
+                             % (compression, sorted(COMPRESSORS)))
+        if compression == 'xz' and lzma is None:
+            raise ImportError('xz needs the lzma module (backports.lzma)')
+        self.outfile, self.compress = outfile, COMPRESSORS[compression]
+        self.threads = int(threads or os.environ.get('COMPRESS_THREADS') or
+                           multiprocessing.cpu_count())
+        self.blocksize = BLOCKSIZE
+        self.pool, self.pending, self.blocks, self.size = None, deque(), [], 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.blocks.append(data)
+        self.size += len(data)
+        if self.size >= self.blocksize:
+            block = ''.join(self.blocks)
+            self.blocks, self.size = [], 0
+            for start in range(0, len(block), self.blocksize):
+                self.submit(block[start:start + self.blocksize])
+        return len(data)
+
+    def submit(self, block):
+        '''
+        queue up the block for compression, writing out compressed blocks
+        while too many are waiting
+        '''
+        if self.pool is None:
+            self.pool = ThreadPool(self.threads)
+        self.pending.append(self.pool.apply_async(self.compress, (block,)))
+        while len(self.pending) > 2 * self.threads:
+            self.outfile.write(self.pending.popleft().get())
+
+    def flush(self):
+        '''
+        write out the blocks compressed so far
+        '''
+        while self.pending and self.pending[0].ready():
+            self.outfile.write(self.pending.popleft().get())
+        if not self.outfile.closed:
+            self.outfile.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.blocks:
+                self.submit(''.join(self.blocks))
+                self.blocks = []
+            while self.pending:
+                self.outfile.write(self.pending.popleft().get())
+            self.outfile.close()
+        finally:
+            self.pending.clear()
+            if self.pool is not None:
+                self.pool.terminate()
+            super(Compressed, self).close()
+
+def reader(infile=None, delimiter=','):
+    r'''
+    iterator of rows of CSV read from infile, stdin by default.
+
+    >>> from io import BytesIO
+    >>> rows = reader(BytesIO('a,b\n\n1,"x,\ny"\n2,3\r\n"4",5'))
+    >>> list(rows)
+    [['a', 'b'], [], ['1', 'x,\ny'], ['2', '3'], ['4', '5']]
+    >>> list(reader(['a|b\n', '\n', 'c|d']))
+    [['a|b'], [], ['c|d']]
+    >>> list(reader(['a|b\n', '"a|b"\n'], '|'))
+    [['a', 'b'], ['a|b']]
+    '''
+    if infile is None:
+        infile = stdin()
+    if is_columnar(infile):
+        return columnar.Reader(infile)
+    rows = csv.reader(infile, delimiter=delimiter)
+    if stats.STATS is None:
+        return rows
+    batches = iter(lambda: list(islice(rows, BATCH)), [])
+    return chain.from_iterable(stats.parsed(batches))
+
+def read_header(infile):
+    r'''
+    read the first record of infile without reading ahead, so that the
+    rest of it can still be read as raw lines, or if columnar, as raw
+    chunks, e.g. by chunk_records.
+
+    >>> from io import BytesIO
+    >>> infile = BytesIO('a,"b\nc"\n1,2\n')
+    >>> read_header(infile), infile.read()
+    (['a', 'b\nc'], '1,2\n')
+    '''
+    if is_columnar(infile):
+        return reader(infile).next()
+    return csv.reader(iter(infile.readline, '')).next()
+
+def is_columnar(infile):
+    r'''
+    whether infile is in the columnar format. if it is at its MAGIC, that
+    is read past, and the file remembered in COLUMNAR, if it can be.
+
+    >>> from io import BytesIO
+    >>> infile = BytesIO(columnar.MAGIC + 'more')
+    >>> is_columnar(infile), infile.read(), is_columnar(infile)
+    (True, 'more', True)
+    >>> is_columnar(BytesIO('a,b\n')), is_columnar(['a,b\n'])
+    (False, False)
+    '''
+    size = len(columnar.MAGIC)
+    if hasattr(infile, 'peek'):
+        start = infile.peek(size)[:size]
+    elif hasattr(infile, 'seek'):
+        try:
+            position = infile.tell()
+            start = infile.read(size)
+            infile.seek(position)
+        except (IOError, ValueError):
+            start = None
+    else:
+        return False
+    if start == columnar.MAGIC:
+        infile.read(size)
+        try:
+            COLUMNAR.add(infile)
+        except TypeError:
+            pass  # can't be remembered, e.g. a cStringIO
+        return True
+    return infile in COLUMNAR
+
+def split_records(batch, delimiter=','):
+    r'''
+    the rows of the complete records in batch, and the number of lines
+    they take, found by parsing it a row at a time.
+
+    >>> split_records(['a,b\n', '"c\n', 'd"\n', '"e\n'])
+    ([['a', 'b'], ['c\nd']], 3)
+    >>> split_records(['a,b\n', 'c\n'])
+    ([['a', 'b'], ['c']], 2)
+    '''
+    reader = csv.reader(chain(batch, [END + '\n']), delimiter=delimiter)
+    rows, end = [], 0
+    for row in reader:
+        if reader.line_num > len(batch):
+            if row == [END]:
+                end = len(batch)
+            break
+        rows.append(row)
+        end = int(reader.line_num)
+    return rows, end
+
+class Writer(object):
+    r'''
+    drop-in replacement for csv.writer(outfile, lineterminator='\n')
+
+    >>> writer = Writer(sys.stdout)
+    >>> writer.writerows([['a', 'b'], ['1', 'x,y'], [''], [1.5, None]])
+    a,b
+    1,"x,y"
+    ""
+    1.5,
+    '''
+    def __init__(self, outfile=None):
+        self.outfile = stdout() if outfile is None else outfile
+        self.writer = csv.writer(self.outfile, lineterminator='\n')
+        # a row at a time, nothing beats csv.writer itself
+        self.writerow = self.writer.writerow
+
+    def writerows(self, rows):
+        '''
+        write rows BATCH at a time, joining all of them at once, and only
+        then checking whether any needed quoting, in which case csv.writer
+        writes the batch.
+        '''
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, BATCH))
+            if not batch:
+                break
+            try:
+                lines = [','.join(row) for row in batch]
+            except TypeError:
+                lines = None
+            if lines is not None and not '' in lines:
+                text = '\n'.join(lines)
+                if ('"' not in text and '\r' not in text and
+                        text.count('\n') == len(lines) - 1 and
+                        text.count(',') == sum(map(len, batch)) - len(batch)):
+                    self.outfile.write(text + '\n')
+                    continue
+            self.writer.writerows(batch)
+
+def writer(outfile=None):
+    '''
+    a Writer to outfile, stdout by default, or the file itself if it
+    takes rows, being columnar
+    '''
+    if outfile is None:
+        outfile = stdout()
+    if isinstance(outfile, ColumnarText):
+        return stats.counted(outfile)
+    return stats.counted(Writer(outfile))
+
+class ColumnarText(object):
+    r'''
+    file object taking CSV text, and writer taking rows, either way writing
+    them to outfile in the columnar format.
+
+    text is parsed a whole number of records at a time, any rest being
+    kept for the next write, or else parsed on close.
+
+    >>> import tempfile
+    >>> filename = tempfile.mkstemp(suffix='.col')[1]
+    >>> text = open_file(filename, 'wb')
+    >>> text.writerow(['a', 'b'])
+    >>> text.write('1,"x\n')
+    >>> text.write('y"\n2,')
+    >>> text.write('z')
+    >>> text.writelines(['\n3,4\n', '5,6\n'])
+    >>> text.close()
+    >>> list(reader(open_file(filename)))
+    [['a', 'b'], ['1', 'x\ny'], ['2', 'z'], ['3', '4'], ['5', '6']]
+    >>> os.remove(filename)
+    '''
+    def __init__(self, outfile):
+        self.writer = columnar.Writer(outfile)
+        self.pending = ''
+
+    def write(self, text):
+        self.pending += text
+        end = self.pending.rfind('\n') + 1
+        if not end:
+            return
+        text, rest = self.pending[:end], self.pending[end:]
+        if '"' in text or '\r' in text:
+            lines = [line + '\n' for line in text[:-1].split('\n')]
+            rows = list(csv.reader(chain(lines, [END + '\n'])))
+            if rows.pop() == [END]:
+                used = len(lines)
+            else:
+                rows, used = split_records(lines)
+            self.pending = ''.join(lines[used:]) + rest
+        else:
+            rows = [line.split(',') if line else []
+                    for line in text[:-1].split('\n')]
+            self.pending = rest
+        self.writer.writerows(rows)
+
+    def writelines(self, lines):
+        '''
+        write lines BATCH at a time, so that they are parsed together
+        '''
+        lines = iter(lines)
+        while True:
+            batch = list(islice(lines, BATCH))
+            if not batch:
+                break
+            self.write(''.join(batch))
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+
+    def writerows(self, rows):
+        self.writer.writerows(rows)
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        if self.pending:
+            self.writer.writerows(csv.reader([self.pending]))
+            self.pending = ''
+        self.writer.close()
+
+def chunk_records(infile, size=CHUNKSIZE):
+    r'''
+    cut infile into chunks of about `size` bytes, ending at record ends.
+
+    the lines are fed to csv.reader, which takes just the lines of one
+    record for each row, so a chunk ends where a row does, however the
+    quotes fall; counting them wouldn't do, since a bare quote inside an
+    unquoted field, as in `a,line",b`, doesn't start a quoted field.
+
+    >>> from io import BytesIO
+    >>> list(chunk_records(BytesIO('1,2\n3,"a\nb"\n4,5\n'), 1))
+    ['1,2\n', '3,"a\nb"\n', '4,5\n']
+    >>> list(chunk_records(BytesIO('a,line",b\nx,"multi\nline"""\n'), 1))
+    ['a,line",b\n', 'x,"multi\nline"""\n']
+
+    columnar input is cut into its chunks, each given the MAGIC, so that
+    it can be read on its own.
+    '''
+    if is_columnar(infile):
+        for chunk in columnar.chunks(infile):
+            yield columnar.MAGIC + chunk
+        return
+    lines, length = [], [0]
+    def feed():
+        for line in infile:
+            lines.append(line)
+            length[0] += len(line)
+            yield line
+    for row in csv.reader(feed()):
+        if length[0] >= size:
+            yield ''.join(lines)
+            del lines[:]
+            length[0] = 0
+    if lines:
+        yield ''.join(lines)
+
+def parse_size(size):
+    '''
+    number of bytes from a size such as 1024, '64k', '512M' or '2G'
+
+    >>> parse_size('512M')
+    536870912
+    >>> parse_size(1024)
+    1024
+    >>> parse_size(True)
+    Traceback (most recent call last):
+        ...
+    ValueError: a size is needed, such as 1024, 64k, 512M or 2G
+    '''
+    if size is True:  # a bare --option
+        raise ValueError('a size is needed, such as 1024, 64k, 512M or 2G')
+    if isinstance(size, (int, long)):
+        return size
+    multiplier = 1
+    suffix = size[-1:].upper()
+    if suffix and suffix in 'KMGT':
+        multiplier = 1024 ** ('KMGT'.index(suffix) + 1)
+        size = size[:-1]
+    return int(float(size) * multiplier)
@@ -1,10 +1,26 @@
 #!/usr/bin/python -OO
 '''
 remove duplicates with (simple) condition.
+
+for very large numbers of distinct keys, --compact=SIZE keeps the counts
+of duplicates in a HashCounter of about SIZE bytes (e.g. --compact=4G)
+rather than a dict of tuples of strings. --bits=128 makes its hashes 128
+bits rather than 64, and --verify makes it exact at the cost of a disk
+read for every repeated hash.
+
+a long run can be made with --checkpoint=DIRECTORY, writing part files
+there rather than to stdout, and saving the counts of duplicates with each
+part, so that if it dies it can be run again to pick up where it left off;
+and with --upload=COMMAND, uploading each part as soon as it's done. see
+checkpoint.py.
 '''
 from __future__ import print_function
-import sys, os, csv, logging
+import sys, os, logging, tempfile, hashlib, struct, shutil
+from array import array
+from operator import itemgetter
 from collections import OrderedDict, defaultdict
+from cStringIO import StringIO
+import csvio, columnar, stats, checkpoint
 logging.basicConfig(level=logging.DEBUG if __debug__ else logging.INFO)
 sys.setcheckinterval(1000000000)
 # http://stackoverflow.com/a/41856587/493161
@@ -16,16 +32,17 @@ else:
     NONDOCTESTPRINT = print
     DOCTESTDEBUG = lambda *args, **kwargs: None
 
-def process(all_or_all_but_one, any_value, *columns):
+def process(all_or_all_but_one, any_value, *columns, **options):
     r'''
     eliminate rows if there are duplicates on the given columns.
 
     first arg is either 'all' or 'all but one', indicating how many rows
     should be returned. be careful using 'all' because it means that the
-    entire file must be buffered before any rows can be written. and
-    we actually have to double-buffer it because the Unix pipe mechanism,
+    entire file must be read before any rows can be written. if the input
+    is seekable, we simply read it again; but the Unix pipe mechanism,
     which is how this is intended to be used, can give an "illegal seek"
-    error. so we store the rowdicts in a buffer.
+    error, so in that case it is copied to a temporary file as it's read
+    the first time. only the counts of duplicates are kept in memory.
 
     next is the value which means "consider any value". the
     example below should make that clear. it removes rows where columns
@@ -34,6 +51,7 @@ def process(all_or_all_but_one, any_value, *columns):
     >>> from io import BytesIO
     >>> sys.stdin = BytesIO('a,b,c\n1,2,0\n2,3,0\n3,2,0\n4,2,1\n5,2,1')
     >>> process('all but one', '_any_', 'b', '_any_', 'c', '0')
+    a,b,c
     1,2,0
     2,3,0
     4,2,1
@@ -43,6 +61,7 @@ def process(all_or_all_but_one, any_value, *columns):
     the check, and requires column c to *not* be '#'.
     >>> sys.stdin = BytesIO('a,b,c\n1,2,0\n2,2,#\n3,2,0\n4,2,#\n')
     >>> process('all but one', '_any_', 'b', '_any_', '!c', '#')
+    a,b,c
     1,2,0
     2,2,#
     4,2,#
@@ -52,88 +71,424 @@ def process(all_or_all_but_one, any_value, *columns):
     should be a condition for printing.
     >>> sys.stdin = BytesIO('a,b,c\n1,2,0\n2,2,0\n3,2,1\n')
     >>> process('all', '_any_', 'b', '_any_', '&c', '0')
+    a,b,c
     3,2,1
+
+    the checks are compiled, once the header is known, into functions of
+    the row list, so no dict need be built for each row.
+
+    the options `compact`, `bits` and `verify` set up a HashCounter in
+    place of the default dict for the counts. with `checkpoint`, the work
+    is handed off to checkpointed.
     '''
-    reader = csv.reader(sys.stdin)
-    writer = csv.writer(sys.stdout, lineterminator='\n')
+    compact = options.pop('compact', None)
+    if compact is not None:
+        compact = csvio.parse_size(compact)
+    bits = int(options.pop('bits', 64))
+    verify = options.pop('verify', False)
+    settings = checkpoint.options(options)
+    if options:
+        raise TypeError('unknown options %s' % options)
+    if settings is not None:
+        if compact is not None:
+            raise ValueError('--checkpoint does not work with --compact,'
+                             ' whose counts cannot be saved')
+        return checkpointed(all_or_all_but_one, any_value, columns, settings)
+    infile = csvio.stdin()
+    spill = None
+    if all_or_all_but_one != 'all but one':
+        try:
+            start = infile.tell()
+            infile.seek(start)
+        except IOError:
+            spill = tempfile.TemporaryFile(prefix='deduplicate.')
+            if csvio.is_columnar(infile):
+                # chunks can't be teed as lines, so spill the lot first
+                spill.write(columnar.MAGIC)
+                shutil.copyfileobj(infile, spill, csvio.BUFSIZE)
+                spill.seek(0)
+                infile, start, spill = spill, 0, None
+            else:
+                infile = tee(infile, spill)
+    reader = csvio.reader(infile)
+    writer = csvio.writer()
     header = reader.next()
     writer.writerow(header)
-    check, additional, seen = OrderedDict({}), OrderedDict({}), defaultdict(int)
+    seen = defaultdict(int)
+    if compact is not None:
+        seen = HashCounter(compact, bits, verify)
+    check, additional = parse_columns(any_value, columns)
+    # the key of a row in `seen`, and whether it counts as a duplicate
+    query = compile_query(check, header)
+    counts = compile_checks(check, header)
+    # additional value checks beyond what counts as 'duplicate'
+    is_match = compile_checks(additional, header)
+
+    if all_or_all_but_one == 'all but one':
+        DOCTESTDEBUG('testing the "all but one" loop')
+        for row in reader:
+            key = query(row)
+            answer = seen[key]  # no need to `bool` it, 0 on first time seen
+            seen[key] += counts(row)
+            if not (answer and is_match(row)):
+                writer.writerow(row)
+    else:
+        DOCTESTDEBUG('testing the "all" loop')
+        DOCTESTDEBUG('first building the dictionary')
+        with stats.timed('count'):
+            for row in reader:
+                key = query(row)
+                seen[key] += counts(row)
+        DOCTESTDEBUG('seen: %s', seen)
+        DOCTESTDEBUG('now performing the checks')
+        if spill is None:
+            infile.seek(start)
+            reader = csvio.reader(infile)
+        else:
+            spill.seek(0)
+            reader = csvio.reader(spill)
+        reader.next()  # header was already written
+        with stats.timed('filter'):
+            for row in reader:
+                if not (seen[query(row)] > 1 and is_match(row)):
+                    writer.writerow(row)
+    if compact is not None:
+        logging.info('%s', seen.report())
+
+def parse_columns(any_value, columns):
+    '''
+    OrderedDicts of the duplicates checks and the additional checks given
+    by the pairs of columns and values, as taken by compile_checks
+
+    >>> parse_columns('_any_', ['b', '_any_', '&!c', '#'])
+    (OrderedDict([('b', ('==', None))]), OrderedDict([('c', ('!=', '#'))]))
+    '''
+    check, additional = OrderedDict({}), OrderedDict({})
     # sweet one-liner from http://stackoverflow.com/a/3125186/493161
     for k, v in map(None, *([iter(columns)] * 2)):
+        value = None if v == any_value else v
         if k.startswith('&'):
             if k[1:].startswith('!'):
-                if v == any_value:
+                if value is None:
                     logging.warn('%s != (any value) will always return False',
                                  k[2:])
-                additional[k[2:]] = ((lambda arg: False) if v == any_value else
-                                     (lambda arg: arg != v))
+                additional[k[2:]] = ('!=', value)
                 DOCTESTDEBUG('added additional check for column %s != %s',
-                             k[2:], "(any value)" if v == any_value else v)
+                             k[2:], "(any value)" if value is None else v)
             else:
-                additional[k[1:]] = ((lambda arg: True) if v == any_value else
-                                     (lambda arg: arg == v))
+                additional[k[1:]] = ('==', value)
                 DOCTESTDEBUG('added additional check for column %s == %s',
-                             k[1:], "(any value)" if v == any_value else v)
+                             k[1:], "(any value)" if value is None else v)
         elif k.startswith('!'):
-            if v == any_value:
+            if value is None:
                 logging.warn('%s != (any value) will always return False',
                              k[1:])
-            check[k[1:]] = ((lambda arg: False) if v == any_value else
-                            (lambda arg: arg != v))
+            check[k[1:]] = ('!=', value)
             DOCTESTDEBUG('added duplicates check for %s == %s', k, v)
         else:
-            check[k] = ((lambda arg: True) if v == any_value else
-                        (lambda arg: arg == v))
+            check[k] = ('==', value)
             DOCTESTDEBUG('added duplicates check for %s == %s', k, v)
     DOCTESTDEBUG('check: %s, additional: %s', check, additional)
+    return check, additional
 
-    def is_duplicate(rowdict, already_built=False):
+def checkpointed(all_or_all_but_one, any_value, columns, settings):
+    r'''
+    process, writing the rows kept from each chunk of stdin to the parts of
+    a checkpoint.Checkpoint made with `settings`, from where the last run
+    left off.
+
+    for 'all but one', the counts changed since the last part are saved
+    with each part. for 'all', the counts of the whole input are saved once
+    made, and an unseekable input is spilled into the checkpoint directory,
+    so that a rerun needn't read either again.
+
+    >>> import tempfile
+    >>> from io import BytesIO
+    >>> directory = tempfile.mkdtemp()
+    >>> sys.stdin = BytesIO('a,b\n1,2\n2,2\n3,3\n')
+    >>> checkpointed('all', '_any_', ['b', '_any_'],
+    ...              {'directory': directory, 'partsize': 1})
+    >>> sorted(os.listdir(directory))
+    ['_checkpoint.json', '_counts', 'part-00000.csv']
+    >>> print(open(os.path.join(directory, 'part-00000.csv')).read(), end='')
+    a,b
+    3,3
+    >>> shutil.rmtree(directory)
+    '''
+    parts = checkpoint.Checkpoint(**settings)
+    if parts.done:
+        logging.info('already done, in %s', settings['directory'])
+        parts.finish()
+        return
+    infile = csvio.stdin()
+    if all_or_all_but_one != 'all but one':
+        infile = seekable(infile, parts)
+    header = csvio.read_header(infile)
+    parts.start(header)
+    check, additional = parse_columns(any_value, columns)
+    query = compile_query(check, header)
+    counts = compile_checks(check, header)
+    is_match = compile_checks(additional, header)
+    if all_or_all_but_one == 'all but one':
+        seen, changed = defaultdict(int), {}
+        for state in parts.states():
+            seen.update(state)
+        for chunk, size in parts.chunks(infile):
+            outfile = StringIO()
+            writer = csvio.writer(outfile)
+            for row in csvio.reader(StringIO(chunk)):
+                key = query(row)
+                answer = seen[key]
+                if counts(row):
+                    seen[key] = changed[key] = answer + 1
+                if not (answer and is_match(row)):
+                    writer.writerow(row)
+            parts.write(outfile.getvalue())
+            if parts.advance(size, lambda: changed):
+                changed.clear()
+    else:
+        seen = parts.load('_counts', load=checkpoint.load_dict)
+        if seen is None:
+            start = infile.tell()
+            seen = defaultdict(int)
+            with stats.timed('count'):
+                for row in csvio.reader(infile):
+                    seen[query(row)] += counts(row)
+            parts.save('_counts', seen, dump=checkpoint.dump_dict)
+            infile.seek(start)
+        with stats.timed('filter'):
+            for chunk, size in parts.chunks(infile):
+                outfile = StringIO()
+                writer = csvio.writer(outfile)
+                for row in csvio.reader(StringIO(chunk)):
+                    if not (seen.get(query(row), 0) > 1 and is_match(row)):
+                        writer.writerow(row)
+                parts.write(outfile.getvalue())
+                parts.advance(size)
+    parts.finish()
+
+def seekable(infile, parts):
+    '''
+    infile, if it can be read again, else a copy of it spilled to the
+    checkpoint `parts`, unless that was done by an earlier run
+    '''
+    try:
+        infile.seek(infile.tell())
+        return infile
+    except IOError:
+        pass
+    spilled = parts.path('_input')
+    if not os.path.exists(spilled):  # only there once complete
+        logging.info('spilling input to %s', spilled)
+        with open(spilled + '.tmp', 'wb') as outfile:
+            if csvio.is_columnar(infile):
+                outfile.write(columnar.MAGIC)
+            shutil.copyfileobj(infile, outfile, csvio.BUFSIZE)
+        os.rename(spilled + '.tmp', spilled)
+    return open(spilled, 'rb')
+
+def column_index(column, header):
+    '''
+    index of column in header; the last one if repeated, as it would be
+    in a dict of the row.
+
+    >>> column_index('b', ['a', 'b', 'c', 'b'])
+    3
+    '''
+    if not column in header:
+        raise ValueError('column "%s" not found in headers %s' % (
+            column, header))
+    return len(header) - 1 - header[::-1].index(column)
+
+def compile_query(checks, header):
+    '''
+    function returning the tuple of values of the checked columns of a row
+
+    >>> compile_query(OrderedDict([('c', None), ('a', None)]),
+    ...               ['a', 'b', 'c'])(['1', '2', '3'])
+    ('3', '1')
+    >>> compile_query({'b': None}, ['a', 'b', 'c'])(['1', '2', '3'])
+    ('2',)
+    '''
+    indexes = [column_index(column, header) for column in checks]
+    if len(indexes) > 1:
+        return itemgetter(*indexes)
+    elif indexes:
+        index = indexes[0]
+        return lambda row: (row[index],)
+    return lambda row: ()
+
+def compile_checks(checks, header):
+    '''
+    function returning True if all the checks on the row pass.
+
+    each check is a column name mapped to an operator, '==' or '!=', and
+    a value, or None for any value. the function is generated as a single
+    expression on the row list, so is about as fast as Python gets.
+
+    >>> is_match = compile_checks(OrderedDict(
+    ...     [('b', ('==', None)), ('c', ('!=', '#')), ('a', ('==', '1'))]),
+    ...     ['a', 'b', 'c'])
+    >>> is_match(['1', '2', '0']), is_match(['1', '2', '#'])
+    (True, False)
+    >>> compile_checks({'a': ('!=', None)}, ['a'])(['1'])
+    False
+    '''
+    terms = []
+    for column, (operator, value) in checks.items():
+        if value is None:
+            if operator == '!=':
+                return lambda row: False
+            continue  # always True
+        terms.append('row[%d] %s %r' % (column_index(column, header),
+                                        operator, value))
+    return eval('lambda row: ' + (' and '.join(terms) or 'True'))
+
+def collision_probability(count, bits):
+    '''
+    chance that any two of `count` distinct keys have the same hash.
+
+    by the birthday approximation, 1 - exp(-n**2 / 2**(bits + 1)); so
+    64-bit hashes are fine for millions of keys, but at a few billion, a
+    collision becomes likely, and 128 bits (or --verify) should be used.
+
+    a collision means two different keys are taken as duplicates.
+
+    >>> '%.2g' % collision_probability(10 ** 6, 64)
+    '2.7e-08'
+    >>> '%.2g' % collision_probability(5 * 10 ** 9, 64)
+    '0.49'
+    >>> '%.2g' % collision_probability(5 * 10 ** 9, 128)
+    '3.7e-20'
+    '''
+    exponent = float(count) ** 2 / 2 ** (bits + 1)
+    if exponent < 1e-6:
+        return exponent  # avoid losing it all to rounding
+    return 1 - pow(2.718281828459045, -exponent)
+
+class HashCounter(object):
+    '''
+    fixed-size stand-in for the defaultdict(int) of duplicate counts.
+
+    each key (a tuple of strings) is stored only as a 64- or 128-bit hash,
+    in an open-addressing table with linear probing, of as many slots as
+    fit in the memory given. counts stop at 255, which is plenty for the
+    "seen before" and "seen more than once" questions asked of them.
+
+    with `verify`, each new key is also appended to a temporary file, and
+    its offset kept in the table, so that a matching hash can be checked
+    against the actual key, making the counts exact.
+
+    >>> seen = HashCounter(1024, verify=True)
+    >>> seen[('a', 'b')], seen[('a', 'c')]
+    (0, 0)
+    >>> seen[('a', 'b')] += 1
+    >>> seen[('a', 'b')] += 1
+    >>> seen[('a', 'b')], seen[('a', 'c')], len(seen)
+    (2, 0, 1)
+    >>> tiny = HashCounter(100)
+    >>> for number in range(7):
+    ...     tiny[(str(number),)] += 1
+    >>> tiny.mask + 1, len(tiny), tiny[('x',)]
+    (8, 7, 0)
+    >>> tiny[('x',)] += 1
+    Traceback (most recent call last):
+        ...
+    ValueError: HashCounter full at 7 keys, needs more memory
+    '''
+    MAXLOAD = 0.9
+
+    def __init__(self, memory, bits=64, verify=False):
+        if bits not in (64, 128):
+            raise ValueError('hashes must be 64 or 128 bits, not %s' % bits)
+        self.words = bits // 64
+        slotsize = 8 * self.words + 1 + (8 if verify else 0)
+        slots = 1
+        while slots * 2 * slotsize <= memory:
+            slots *= 2
+        self.mask, self.used = slots - 1, 0
+        self.hashes = [array('L', [0]) * slots for word in range(self.words)]
+        self.counts = bytearray(slots)
+        self.keys = self.offsets = None
+        if verify:
+            self.keys = tempfile.TemporaryFile(prefix='deduplicate.')
+            self.offsets = array('L', [0]) * slots
+
+    def __len__(self):
+        return self.used
+
+    def find(self, key, insert=False):
+        '''
+        slot number of key, or None if it isn't there and not `insert`ing
         '''
-        counts duplicate if all checks are True
+        serialized = '\0'.join(key)
+        digest = struct.unpack('<QQ', hashlib.md5(serialized).digest())
+        digest = [word or 1 for word in digest[:self.words]]  # 0 is empty
+        slot = digest[0] & self.mask
+        while self.hashes[0][slot]:
+            if (all(self.hashes[word][slot] == digest[word]
+                    for word in range(1, self.words)) and
+                    self.hashes[0][slot] == digest[0] and
+                    (self.keys is None or
+                     self.stored(slot) == serialized)):
+                return slot
+            slot = (slot + 1) & self.mask
+        if not insert:
+            return None
+        # at least one slot must stay empty, to end the probing above
+        if self.used + 1 > self.MAXLOAD * (self.mask + 1):
+            raise ValueError('HashCounter full at %d keys, needs more memory'
+                             % self.used)
+        for word in range(self.words):
+            self.hashes[word][slot] = digest[word]
+        if self.keys is not None:
+            self.keys.seek(0, os.SEEK_END)
+            self.offsets[slot] = self.keys.tell()
+            self.keys.write(struct.pack('<I', len(serialized)) + serialized)
+        self.used += 1
+        return slot
 
-        function has a side effect, building the duplicates list as it goes
+    def stored(self, slot):
         '''
-        query = tuple([rowdict[c] for c in check])
-        if not already_built:
-            answer = seen[query]  # no need to `bool` it, 0 on first time seen
-            seen[query] += all([check[c](rowdict[c]) for c in check])
-            DOCTESTDEBUG('seen (unbuilt): %s, answer=%s', seen, answer)
-        else:
-            answer = seen[query] > 1
-            DOCTESTDEBUG('seen (built): %s, answer=%s', seen, answer)
-        return answer
+        the actual key stored for a slot, when verifying
+        '''
+        self.keys.seek(self.offsets[slot])
+        length = struct.unpack('<I', self.keys.read(4))[0]
+        return self.keys.read(length)
+
+    def __getitem__(self, key):
+        slot = self.find(key)
+        return 0 if slot is None else self.counts[slot]
 
-    def is_match(rowdict):
+    def __setitem__(self, key, count):
+        self.counts[self.find(key, True)] = min(count, 255)
+
+    def report(self):
         '''
-        additional value checks beyond what counts as 'duplicate'
+        how full the table is, and the chance of a false duplicate
         '''
-        DOCTESTDEBUG('looking for match of %s in %s',
-                     [[c, rowdict[c]] for c in additional], additional)
-        return all([additional[c](rowdict[c]) for c in additional])
-    
-    if all_or_all_but_one == 'all but one':
-        DOCTESTDEBUG('testing the "all but one" loop')
-        for row in reader:
-            rowdict = OrderedDict(zip(header, row))
-            if not (is_duplicate(rowdict) and is_match(rowdict)):
-                writer.writerow(row)
-    else:
-        rowbuffer = []
-        DOCTESTDEBUG('testing the "all" loop')
-        DOCTESTDEBUG('first building the dictionary')
-        for row in reader:
-            rowbuffer.append(row)
-            rowdict = OrderedDict(zip(header, row))
-            is_duplicate(rowdict) # just populate the `seen` dictionary
-        DOCTESTDEBUG('now performing the checks')
-        for row in rowbuffer:
-            rowdict = OrderedDict(zip(header, row))
-            DOCTESTDEBUG('%s is_duplicate: %s, is_match: %s', row,
-                         is_duplicate(rowdict, True),
-                         is_match(rowdict))
-            if not (is_duplicate(rowdict, True) and is_match(rowdict)):
-                writer.writerow(row)
+        slots = self.mask + 1
+        return ('HashCounter: %d of %d slots used (%.1f%%), '
+                'collision probability %s' % (
+                    self.used, slots, 100.0 * self.used / slots,
+                    0 if self.keys is not None else '%.2g' %
+                    collision_probability(self.used, 64 * self.words)))
+
+def tee(infile, copy):
+    r'''
+    yield the lines of infile, having first written them to copy
+
+    >>> from io import BytesIO
+    >>> copy = BytesIO()
+    >>> list(tee(BytesIO('a\nb\n'), copy)), copy.getvalue()
+    (['a\n', 'b\n'], 'a\nb\n')
+    '''
+    for line in infile:
+        copy.write(line)
+        yield line
 
 if __name__ == '__main__':
-    process(*sys.argv[1:])
+    ARGS = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    OPTIONS = dict((arg[2:].split('=', 1) + [True])[:2]
+                   for arg in sys.argv[1:] if arg.startswith('--'))
+    process(*ARGS, **OPTIONS)
@@ -0,0 +1,105 @@
+#!/usr/bin/python -OO
+'''
+generate synthetic tables like those in data/, of any size, for
+benchmark.py or for trying out the filters on more than a few lines.
+
+writes sales.csv, billing.csv and salesmen.csv into the given directory,
+e.g. `./generate.py /tmp/example/data --rows=1000000 --skew=1`:
+    --rows=N        rows of sales (100000 by default)
+    --salesmen=N    rows of salesmen (1000), with ids from 0
+    --billing=N     rows of billing (1000), with ids following those
+    --ids=N         distinct ids the sales are drawn from (as many as rows),
+                    so that the salesmen and billing ids are among them
+    --duplicates=F  fraction of rows of each table that repeat one of the
+                    rows shortly before them exactly (0.01)
+    --skew=F        0 for ids drawn uniformly; the higher, the more the
+                    sales are concentrated on the lowest ids (0)
+    --seed=N        for the random numbers, so that the same options give
+                    the same files (0)
+'''
+from __future__ import print_function
+import sys, os, random, logging
+from collections import deque
+import csvio
+logging.basicConfig(level=logging.DEBUG if __debug__ else logging.INFO)
+# rows before each row, from which its duplicate is chosen
+RECENT = 1000
+# fraction of sales with no expenses
+EMPTY = 0.01
+
+def process(directory, rows=100000, salesmen=1000, billing=1000, ids=None,
+            duplicates=0.01, skew=0, seed=0):
+    '''
+    write the three tables into directory, creating it if need be
+    '''
+    rows, salesmen, billing = int(rows), int(salesmen), int(billing)
+    ids = rows if ids is None else int(ids)
+    duplicates, skew = float(duplicates), float(skew)
+    rng = random.Random(int(seed))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    tables = [
+        ('sales.csv', ['id', 'gross', 'expenses'],
+         sales(rng, rows, ids, skew)),
+        ('salesmen.csv', ['id', 'employee'],
+         employees(rng, salesmen, 0)),
+        ('billing.csv', ['id', 'employee'],
+         employees(rng, billing, salesmen)),
+    ]
+    for filename, header, table in tables:
+        path = os.path.join(directory, filename)
+        logging.debug('writing %s', path)
+        with csvio.open_file(path, 'wb') as outfile:
+            writer = csvio.writer(outfile)
+            writer.writerow(header)
+            writer.writerows(duplicated(rng, table, duplicates))
+
+def sales(rng, count, ids, skew):
+    '''
+    count rows of id, gross and expenses, the ids drawn from range(ids)
+
+    >>> list(sales(random.Random(0), 2, 10, 0))
+    [['8', '75796', '3187.76'], ['2', '51127', '2070.31']]
+    '''
+    exponent = 1 + skew
+    for number in xrange(count):
+        id = int(ids * rng.random() ** exponent)
+        gross = rng.randint(0, 100000)
+        expenses = rng.random()
+        yield [str(id), str(gross), '' if expenses < EMPTY else
+               '%.2f' % (expenses * gross / 10)]
+
+def employees(rng, count, first):
+    '''
+    count rows of id and employee name, with ids from first on
+
+    >>> list(employees(random.Random(0), 2, 5))
+    [['5', 'rihikoji'], ['6', 'vihope']]
+    '''
+    consonants, vowels = 'bdfghjklmnpqrstvz', 'aeiou'
+    for id in xrange(first, first + count):
+        name = ''.join(rng.choice(consonants) + rng.choice(vowels)
+                       for syllable in range(rng.randint(2, 4)))
+        yield [str(id), name]
+
+def duplicated(rng, rows, fraction):
+    '''
+    rows, with the given fraction of them replaced by a copy of one of the
+    RECENT before them
+
+    >>> list(duplicated(random.Random(1), iter('abcdef'), 0.5))
+    ['a', 'a', 'c', 'a', 'c', 'f']
+    '''
+    recent = deque(maxlen=RECENT)
+    for row in rows:
+        if recent and rng.random() < fraction:
+            row = rng.choice(recent)
+        else:
+            recent.append(row)
+        yield row
+
+if __name__ == '__main__':
+    ARGS = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    OPTIONS = dict((arg[2:].split('=', 1) + [True])[:2]
+                   for arg in sys.argv[1:] if arg.startswith('--'))
+    process(*ARGS, **OPTIONS)
@@ -11,17 +11,89 @@ SHELL=/bin/bash in the Makefile, and use process substitution to filter
 them, e.g.:
     cat intermediate.csv | ./left_outer_join.py 'Customer ID - Key' \
         <(cat bad.psv | tr '\222' "'" | ./bad_psv.py)
+
+if the right table is too big to fit in RAM, give a memory budget with
+--memory, e.g. `./left_outer_join.py --memory=2G id huge.csv`, and a grace
+hash join is done instead: both tables are partitioned on the hash of the
+key into temporary bucket files, and each pair of buckets joined in memory.
+no more buckets are made at once than there can be open files, and any
+right bucket still too big is partitioned again, with another hash. note
+that the output is then grouped by bucket rather than in input order.
+
+if the same big right table is joined to many left tables, --index builds
+(the first time, or whenever the table's size or mtime changes) a file
+next to it, e.g. huge.csv.id.idx, of key hashes and row offsets. later runs
+memory-map the index and the table, and read only the rows they need.
+
+rather than pipelining several joins, each of which has to parse and
+format the ever-widening rows again, you can give several key=table pairs
+to one invocation, e.g.:
+    cat facts.csv | ./left_outer_join.py 'Customer ID=customers.csv' \
+        'Product ID=products.csv' 'Region=<(./goodpsv.py < regions.psv)'
+the result is the same as that of the pipeline, each key being looked for
+first in the left table and then in the right tables joined before it.
+
+if both tables are already sorted on the key, --sorted does a merge join,
+streaming both, and holding only the right rows for the current key in
+memory. keys must be in `LC_ALL=C sort` order, or with --sorted=numeric,
+in numeric order, after any keys that aren't numbers, such as empty ones,
+as `LC_ALL=C sort -g` has them; a key out of order in either table is a
+fatal error.
+
+the probing of the right-hand tables, and the parsing and formatting of
+CSV that goes with it, can be spread over a pool of processes with
+--workers=N. the left table is cut into chunks of whole records, which the
+workers join against their (copy-on-write, forked) copy of the right-hand
+tables. the output is written in input order, unless --unordered is given,
+in which case chunks are written as soon as they're done.
+
+right-hand tables, like the left table on stdin, may be gzip, bzip2 or xz
+compressed, e.g. `./left_outer_join.py id customers.csv.gz`, though not
+with --index, which needs the offsets of rows in the table itself.
+
+with $STATS set (see stats.py), the time taken by build_dict, probe and
+the other stages of the join is reported at exit.
+
+a long single join can be run with --checkpoint=DIRECTORY, writing part
+files there rather than to stdout, so that if it dies it can be run again
+to pick up where it left off, without building the right-hand dict again;
+and with --upload=COMMAND, uploading each part as soon as it's done. see
+checkpoint.py.
 '''
 from __future__ import print_function
-import sys, os, csv, logging
-from collections import defaultdict
+import sys, os, csv, logging, tempfile, shutil, zlib, multiprocessing
+import json, mmap, struct, hashlib, bisect, marshal
+from array import array
+from collections import deque
+from itertools import imap
+from cStringIO import StringIO
+import csvio, stats, checkpoint
+from csvio import chunk_records
+try:
+    import resource
+except ImportError:
+    resource = None
 logging.basicConfig(level=logging.DEBUG if __debug__ else logging.INFO)
 sys.setcheckinterval(1000000000)
 
 COMMAND = os.path.splitext(os.path.basename(sys.argv[0]))[0]
 DOCTESTDEBUG = logging.debug if COMMAND == 'doctest' else lambda *args: None
+# rough ratio of in-memory CompactTable size to CSV size of the right-hand
+# table, about 4.5 for 1M rows of calculated.csv
+EXPANSION = 5
+# rough ratio of CSV size to compressed size of the right-hand table
+COMPRESSION = 5
+# number of buckets used when the size of the right-hand table is unknown
+FANOUT = 64
+# most buckets made at once, and file descriptors left for anything else
+MAXFANOUT = 512
+RESERVED = 32
+# times a bucket is partitioned again, at most, if still too big
+MAXDEPTH = 4
+# function(left_reader, outfile) run by the workers on each chunk
+WORKER = None
 
-def process(key, right_hand_table):
+def process(*joins, **options):
     '''
     read lines as CSV and perform a left outer join, which means, in
     my particular context (pseudocode):
@@ -34,65 +106,1043 @@ def process(key, right_hand_table):
     don't trap reader.next() on first lines; we want to know
     if it breaks there. past that point, we can simply assume someone ran
     `head` or `tail` or something similar to truncate the data.
+
+    if `memory` is given, as a number of bytes or a string such as '512M',
+    and the right-hand table is not known to fit within it, hand off to
+    grace_join.
+
+    if `index` is set, the right-hand table is looked up through its
+    on-disk index (see RightIndex) rather than loaded into a dict.
+
+    the joins are either a key and right-hand table, or any number of
+    'key=right_hand_table' strings, in which case star_join does the work.
+
+    if `workers` is given, the probe phase runs in that many processes,
+    and if `unordered` is set, its output is not kept in input order.
+
+    if `checkpoint` is given, a single join is handed off to
+    checkpointed_join.
     '''
-    right_header, right_index, right_data = build_dict(right_hand_table, key)
-    left_reader = csv.reader(sys.stdin)
-    left_header = left_reader.next()
-    if not key in left_header:
-        raise ValueError('Specified key "%s" not found in'
-                         ' left hand table headers %s' % (key, left_header))
-    left_index = left_header.index(key)
-    writer = csv.writer(sys.stdout, lineterminator='\n')
+    memory = options.pop('memory', None)
+    index = options.pop('index', False)
+    order = options.pop('sorted', None)
+    workers = int(options.pop('workers', 0))
+    ordered = not options.pop('unordered', False)
+    settings = checkpoint.options(options)
+    if options:
+        raise TypeError('unknown options %s' % options)
+    if workers and (memory is not None or order is not None):
+        raise ValueError('--workers does not work with --memory or --sorted')
+    if settings and (memory is not None or not ordered):
+        raise ValueError('--checkpoint does not work with --memory'
+                         ' or --unordered')
+    joins = parse_joins(joins)
+    if len(joins) > 1:
+        if memory is not None or order is not None:
+            raise ValueError('--memory and --sorted only work for'
+                             ' a single join')
+        if settings:
+            raise ValueError('--checkpoint only works for a single join')
+        return star_join(joins, open_index if index else build_dict,
+                         workers, ordered)
+    key, right_hand_table = joins[0]
+    if settings:
+        if order is not None:
+            load = lambda table, key: open_sorted(table, key, order)
+        else:
+            load = open_index if index else build_dict
+        return checkpointed_join(key, right_hand_table, load, settings,
+                                 workers)
+    if order is not None:
+        right_header, right_index, right_data = open_sorted(
+            right_hand_table, key, order)
+    elif index:
+        right_header, right_index, right_data = open_index(
+            right_hand_table, key)
+    elif memory is not None:
+        memory = csvio.parse_size(memory)
+        buckets = bucket_count(right_hand_table, memory)
+        if buckets > 1:
+            return grace_join(key, right_hand_table, buckets, memory)
+        right_header, right_index, right_data = build_dict(
+            right_hand_table, key)
+    else:
+        right_header, right_index, right_data = build_dict(
+            right_hand_table, key)
+    left_header = csvio.read_header(csvio.stdin())
+    left_index = key_index(key, left_header, 'left')
+    writer = csvio.writer()
     writer.writerow(left_header + right_header)
-    no_match = [''] * len(right_header)
+    width = len(right_header)
+    probe(lambda left_reader, outfile: join(
+        left_reader, left_index, right_data, width, outfile),
+          workers, ordered)
+    if isinstance(right_data, SortedTable):
+        right_data.finish()
+
+@stats.stage('probe')
+def probe(worker, workers=0, ordered=True):
+    '''
+    run worker(left_reader, outfile) on the rest of stdin, either directly
+    or on chunks of it in a pool of `workers` processes.
+
+    the worker is passed to the pool processes through the global WORKER,
+    since they are forked after it is set, so that the right-hand data
+    needn't be pickled.
+    '''
+    if not workers:
+        worker(csvio.reader(), stats.lines(csvio.stdout()))
+        return
+    global WORKER
+    WORKER = worker
+    pool = multiprocessing.Pool(workers)
+    outfile = stats.lines(csvio.stdout())
+    try:
+        mapper = pool.imap if ordered else pool.imap_unordered
+        for output in mapper(join_chunk, chunk_records(csvio.stdin())):
+            outfile.write(output)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def join_chunk(chunk):
+    '''
+    run the WORKER on a chunk of the left table, returning its output
+    '''
+    outfile = StringIO()
+    WORKER(csvio.reader(StringIO(chunk)), outfile)
+    return outfile.getvalue()
+
+def checkpointed_join(key, right_hand_table, load, settings, workers=0):
+    '''
+    the single join, with `load` being build_dict, open_index or
+    open_sorted, written to the parts of a checkpoint.Checkpoint made with
+    `settings`, as join_chunk's output for each chunk of stdin from where
+    the last run left off, in a pool of `workers` processes, if given.
+
+    the dict made by build_dict is saved in the checkpoint, stamped with
+    the size and time of the right-hand table, if it is a regular file.
+    '''
+    parts = checkpoint.Checkpoint(**settings)
+    if parts.done:
+        logging.info('already done, in %s', settings['directory'])
+        parts.finish()
+        return
+    loaded, stamp = None, None
+    if load is build_dict and os.path.isfile(right_hand_table):
+        stat = os.stat(right_hand_table)
+        stamp = {'table': os.path.abspath(right_hand_table), 'key': key,
+                 'size': stat.st_size, 'mtime': stat.st_mtime}
+        loaded = parts.load('_right', stamp, load_right)
+    if loaded is not None:
+        right_header, right_index, right_data = loaded
+    else:
+        right_header, right_index, right_data = load(right_hand_table, key)
+        if stamp is not None:
+            parts.save('_right', (right_header, right_index, right_data),
+                       stamp, dump=dump_right)
+    left_header = csvio.read_header(csvio.stdin())
+    left_index = key_index(key, left_header, 'left')
+    parts.start(left_header + right_header)
+    width = len(right_header)
+    global WORKER
+    WORKER = lambda left_reader, outfile: join(
+        left_reader, left_index, right_data, width, outfile)
+    sizes = deque()
+    def chunks():
+        for chunk, size in parts.chunks(csvio.stdin()):
+            sizes.append(size)
+            yield chunk
+    pool = multiprocessing.Pool(workers) if workers else None
+    try:
+        with stats.timed('probe'):
+            mapper = pool.imap if pool else imap
+            for output in mapper(join_chunk, chunks()):
+                parts.write(output)
+                parts.advance(sizes.popleft())
+        if pool:
+            pool.close()
+    except:
+        if pool:
+            pool.terminate()
+        raise
+    finally:
+        if pool:
+            pool.join()
+    if isinstance(right_data, SortedTable):
+        right_data.finish()
+    parts.finish()
+
+def dump_right(right, outfile):
+    '''
+    write build_dict's header, index and CompactTable to outfile
+    '''
+    right_header, right_index, right_data = right
+    marshal.dump((right_header, right_index), outfile, 2)
+    right_data.dump(outfile)
+
+def load_right(infile):
+    '''
+    build_dict's header, index and CompactTable, as written by dump_right
+    '''
+    right_header, right_index = marshal.load(infile)
+    return right_header, right_index, CompactTable.load(infile)
+
+def join(left_reader, left_index, right_data, width, outfile):
+    r'''
+    write each left row joined with every matching right row, or with
+    empty columns if there is no match.
+
+    the right rows come already formatted as CSV text, by `splice`, so
+    are simply spliced onto the formatted left row; since the writer
+    quotes each field on its own merits, this gives the same bytes as
+    writing the whole row with csv.writer, even for a right row with no
+    columns but the key.
+
+    >>> from io import BytesIO
+    >>> right = build_dict(BytesIO('id,y\n1\n2,q\n3,\n'), 'id')[2]
+    >>> join(csvio.reader(BytesIO('1,a\n2,b\n3,c\n4,d\n')), 0, right, 1,
+    ...      sys.stdout)
+    1,a
+    2,b,q
+    3,c,
+    4,d,
+    '''
+    if not width:
+        writer = csvio.writer(outfile)
+        for row in left_reader:
+            for columns in right_data.get(row[left_index], ['']):
+                writer.writerow(row)
+        return
+    no_match = splice([''] * width)
     for row in left_reader:
-        lastcolumns = right_data.get(row[left_index], [no_match])
-        for columns in lastcolumns:
-            writer.writerow(row + columns)
+        left = serialize(row)
+        for columns in right_data.get(row[left_index], [no_match]):
+            outfile.write(left + columns + '\n')
+
+def parse_joins(joins):
+    '''
+    list of (key, right_hand_table) pairs from the command-line args
+
+    >>> parse_joins(['id', 'sales.csv'])
+    [('id', 'sales.csv')]
+    >>> parse_joins(['id=sales.csv', 'Region=/dev/fd/63'])
+    [('id', 'sales.csv'), ('Region', '/dev/fd/63')]
+    '''
+    if len(joins) == 2 and not '=' in joins[0]:
+        return [tuple(joins)]
+    if not joins or not all('=' in join for join in joins):
+        raise ValueError('expected key and table, or key=table pairs, not %s'
+                         % (joins,))
+    return [tuple(join.split('=', 1)) for join in joins]
+
+def star_join(joins, load, workers=0, ordered=True):
+    '''
+    left outer join of stdin with each of the right-hand tables in turn,
+    in a single pass.
+
+    all the right-hand tables are loaded first. then each left row is
+    parsed once, looked up in every table, and every combination of
+    matches written out once.
+
+    each key is found in the left table if it's there, otherwise in the
+    first right-hand table joined before it that has it. in the latter
+    case the matching right rows, kept as CSV, have to be parsed again to
+    find the key; this is the slow path.
+    '''
+    left_header = csvio.read_header(csvio.stdin())
+    header, sources, lookups = load_joins(joins, load, left_header)
+    writer = csvio.writer()
+    writer.writerow(header)
+    probe(lambda left_reader, outfile: star_rows(
+        left_reader, lookups, sources, outfile), workers, ordered)
+
+def load_joins(joins, load, left_header):
+    '''
+    load each right-hand table, and work out where its key comes from.
+
+    returns the joined header; the list of headers of the left table and
+    of each right table less its key; and the list of lookups used by
+    star_match.
+    '''
+    header, sources, lookups = list(left_header), [left_header], []
+    for key, right_hand_table in joins:
+        right_header, right_index, right_data = load(right_hand_table, key)
+        for source, source_header in enumerate(sources):
+            if key in source_header:
+                break
+        else:
+            raise ValueError('Specified key "%s" not found in'
+                             ' left hand table headers %s' % (key, header))
+        lookups.append((source - 1, source_header.index(key), right_data,
+                        splice([''] * len(right_header))))
+        header.extend(right_header)
+        sources.append(right_header)
+    return header, sources, lookups
+
+def transform(rows, *joins):
+    r'''
+    the join as a generator of rows, for pipeline.py, taking an iterator
+    of rows of the left table, header first. the joins are as for process.
+
+    >>> from io import BytesIO
+    >>> right = BytesIO('id,name\n1,"a\nb"\n1,c\n3,\n')
+    >>> list(transform(iter([['n', 'id'], ['x', '1'], ['y', '2']]),
+    ...                'id', right))
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [['n', 'id', 'name'], ['x', '1', 'a\nb'], ['x', '1', 'c'],
+     ['y', '2', '']]
+    '''
+    left_header = next(rows)
+    header, sources, lookups = load_joins(parse_joins(joins), build_parsed,
+                                          left_header)
+    lookups = [(source, index, right_data, [''] * len(columns))
+               for (source, index, right_data, no_match), columns
+               in zip(lookups, sources[1:])]
+    yield header
+    for row in rows:
+        for matches in star_match(row, lookups):
+            joined = list(row)
+            for columns in matches:
+                joined.extend(columns)
+            yield joined
+
+def star_rows(left_reader, lookups, sources, outfile):
+    '''
+    write each left row joined with every combination of its matches
+    '''
+    if not any(sources[1:]):
+        # no right columns at all, so only need the number of matches
+        writer = csvio.writer(outfile)
+        for row in left_reader:
+            for count in range(len(star_match(row, lookups))):
+                writer.writerow(row)
+        return
+    # tables with no columns but the key add nothing, not even a comma,
+    # since their rows are spliced as ''
+    for row in left_reader:
+        left = serialize(row)
+        for matches in star_match(row, lookups):
+            outfile.write(''.join([left] + matches) + '\n')
+
+def star_match(row, lookups):
+    '''
+    list of lists of CSV-formatted right rows, or of rows already parsed
+    into lists, one for each combination of matches of the left row in the
+    lookups.
+
+    >>> star_match(['1', 'x'], [(-1, 0, {'1': [',a', ',b']}, ','),
+    ...                         (0, 0, {'a': [',c']}, ',')])
+    [[',a', ',c'], [',b', ',']]
+    >>> star_match(['1'], [(-1, 0, {'1': [['a']]}, ['']),
+    ...                    (0, 0, {'a': [['c']]}, [''])])
+    [[['a'], ['c']]]
+    '''
+    combinations = [[]]
+    for source, index, right_data, no_match in lookups:
+        extended = []
+        for matches in combinations:
+            if source < 0:
+                value = row[index]
+            elif isinstance(matches[source], list):
+                value = matches[source][index] if matches[source] else ''
+            elif matches[source]:
+                value = csv.reader([matches[source]]).next()[index + 1]
+            else:
+                value = ''  # no match in table, so lookup as the empty key
+            for columns in right_data.get(value, [no_match]):
+                extended.append(matches + [columns])
+        combinations = extended
+    return combinations
+
+SERIALIZED = StringIO()
+# same lineterminator as the output, since it decides what gets quoted
+SERIALIZER = csv.writer(SERIALIZED, lineterminator='\n')
+
+def serialize(row):
+    '''
+    CSV text of a row, without line terminator, ready to splice to others.
+
+    the writer makes `""` of a row with one empty field, to tell it apart
+    from an empty line; but as part of a longer row it must be empty.
+
+    >>> serialize(['1', 'a,b', ''])
+    '1,"a,b",'
+    >>> serialize([''])
+    ''
+    '''
+    if not row or row == ['']:
+        return ''
+    line = ','.join(row)
+    # as csvio.Writer.writerows does, only quoting needs csv.writer
+    if not ('"' in line or '\n' in line or '\r' in line or
+            line.count(',') != len(row) - 1):
+        return line
+    SERIALIZED.seek(0)
+    SERIALIZED.truncate()
+    SERIALIZER.writerow(row)
+    return SERIALIZED.getvalue()[:-1]
+
+def splice(row):
+    '''
+    CSV text of a row with a comma before it, ready to splice onto another
+    row, or '' for a row of no columns, to which a row of one empty column,
+    ',', must not be the same.
+
+    >>> splice(['a', 'b,c']), splice(['']), splice([])
+    (',a,"b,c"', ',', '')
+    '''
+    return ',' + serialize(row) if row else ''
+
+def key_index(key, header, side):
+    '''
+    index of key in header, with a useful message if it isn't there
+
+    >>> key_index('b', ['a', 'b'], 'left')
+    1
+    '''
+    if not key in header:
+        raise ValueError('Specified key "%s" not found in'
+                         ' %s hand table headers %s' % (key, side, header))
+    return header.index(key)
+
+def bucket_count(filename, memory):
+    '''
+    how many buckets the right-hand table must be split into, such that
+    each one can be made into a dict within the memory budget, but no more
+    than max_fanout().
+
+    pipes, devices and open files are of unknown size, so get FANOUT buckets.
+
+    >>> bucket_count(os.devnull, 1024) == FANOUT
+    True
+    '''
+    try:
+        size = os.stat(filename).st_size
+    except (TypeError, OSError):
+        return min(FANOUT, max_fanout())
+    if not os.path.isfile(filename):
+        return min(FANOUT, max_fanout())
+    if csvio.is_compressed(filename):
+        size *= COMPRESSION
+    return max(1, min(-(-size * EXPANSION // memory), max_fanout()))
+
+def max_fanout():
+    '''
+    most bucket files that can be open at once, leaving RESERVED file
+    descriptors for everything else, and no more than MAXFANOUT
+
+    >>> 2 <= max_fanout() <= MAXFANOUT
+    True
+    '''
+    if resource is None:
+        return MAXFANOUT
+    limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    if limit == resource.RLIM_INFINITY:
+        return MAXFANOUT
+    return max(2, min(MAXFANOUT, limit - RESERVED))
+
+def bucket(value, buckets, depth=0):
+    '''
+    stable bucket number for a key value, the same for both tables.
 
+    a bucket partitioned again, at a greater depth, is so by a hash of the
+    value unrelated to the crc32 that put all its keys in it; a crc32 with
+    another start value wouldn't do, being the same but for a constant.
+
+    >>> bucket('12345', 8) == bucket('12345', 8)
+    True
+    >>> len(set(bucket(str(n * 8), 8, 1) for n in range(100)))
+    8
+    '''
+    if depth:
+        value = hashlib.md5('%d:%s' % (depth, value)).digest()
+    return (zlib.crc32(value) & 0xffffffff) % buckets
+
+@stats.stage('partition')
+def partition(reader, index, buckets, directory, prefix, header=None,
+              depth=0):
+    '''
+    write each row of reader to the bucket file for its key, by the hash
+    of the given depth, returning the list of bucket filenames.
+
+    if a header is given, it is written at the top of each bucket file,
+    so that the bucket can be fed as-is to build_dict.
+    '''
+    filenames = [os.path.join(directory, '%s%05d.csv' % (prefix, n))
+                 for n in range(buckets)]
+    files = [open(filename, 'wb') for filename in filenames]
+    try:
+        writers = [csvio.writer(outfile) for outfile in files]
+        if header is not None:
+            for writer in writers:
+                writer.writerow(header)
+        for row in reader:
+            writers[bucket(row[index], buckets, depth)].writerow(row)
+    finally:
+        for outfile in files:
+            outfile.close()
+    return filenames
+
+def grace_join(key, right_hand_table, buckets, memory):
+    '''
+    left outer join for right-hand tables too big to fit in RAM.
+
+    both tables are hash-partitioned on the key into `buckets` temporary
+    files each. since equal keys always land in the same bucket number,
+    joining each pair of buckets in memory, with the same build_dict and
+    so the same duplicate discarding, gives the same rows as the plain join.
+    '''
+    directory = tempfile.mkdtemp(prefix='left_outer_join.')
+    logging.debug('partitioning into %d buckets under %s', buckets, directory)
+    try:
+        if isinstance(right_hand_table, basestring):
+            infile = csvio.open_file(right_hand_table)
+        else:
+            infile = right_hand_table
+        with infile as tableinput:
+            right_reader = csvio.reader(tableinput)
+            header = right_reader.next()
+            right_buckets = partition(right_reader,
+                                      key_index(key, header, 'right'),
+                                      buckets, directory, 'right', header)
+        left_reader = csvio.reader()
+        left_header = left_reader.next()
+        left_index = key_index(key, left_header, 'left')
+        left_buckets = partition(left_reader, left_index, buckets,
+                                 directory, 'left')
+        right_header = [h for h in header if h != key]
+        writer = csvio.writer()
+        writer.writerow(left_header + right_header)
+        for left_bucket, right_bucket in zip(left_buckets, right_buckets):
+            join_buckets(key, left_index, left_bucket, right_bucket,
+                         len(right_header), memory)
+    finally:
+        shutil.rmtree(directory)
+
+def join_buckets(key, left_index, left_bucket, right_bucket, width, memory,
+                 depth=1):
+    '''
+    join a pair of bucket files, in memory, or if the right one is still
+    too big for it, by partitioning both again, with the hash of the given
+    depth, and joining each pair of those, up to MAXDEPTH.
+    '''
+    buckets = bucket_count(right_bucket, memory)
+    if buckets > 1 and depth < MAXDEPTH:
+        directory = tempfile.mkdtemp(dir=os.path.dirname(right_bucket))
+        logging.debug('partitioning %s into %d buckets under %s',
+                      right_bucket, buckets, directory)
+        with open(right_bucket, 'rb') as right_input:
+            right_reader = csvio.reader(right_input)
+            header = right_reader.next()
+            right_buckets = partition(right_reader,
+                                      key_index(key, header, 'right'),
+                                      buckets, directory, 'right', header,
+                                      depth)
+        with open(left_bucket, 'rb') as left_input:
+            left_buckets = partition(csvio.reader(left_input), left_index,
+                                     buckets, directory, 'left', None, depth)
+        os.remove(right_bucket)
+        os.remove(left_bucket)
+        for pair in zip(left_buckets, right_buckets):
+            join_buckets(key, left_index, pair[0], pair[1], width, memory,
+                         depth + 1)
+        return
+    if buckets > 1:
+        logging.warning('%s still too big for --memory after %d partitions;'
+                        ' too many rows with one key?', right_bucket, depth)
+    right_data = build_dict(right_bucket, key)[2]
+    with open(left_bucket, 'rb') as left_input:
+        join(csvio.reader(left_input), left_index, right_data, width,
+             stats.lines(csvio.stdout()))
+
+@stats.stage('build_dict')
 def build_dict(filename, key):
     r'''
     build a dict, keyed with the given key, of data in the right-hand table.
 
+    the "dict" is a CompactTable, whose values are the remaining columns
+    of each row, formatted as CSV by `splice`.
+
     ugly hack put in to use an open file object for testing.
 
     >>> from io import BytesIO
-    >>> build_dict(BytesIO('a,b,c\n1,2,3\n4,5,6\n'), 'b')
-    (['a', 'c'], 1, {'2': [['1', '3']], '5': [['4', '6']]})
+    >>> header, index, data = build_dict(BytesIO('a,b,c\n1,2,3\n4,5,6\n'), 'b')
+    >>> header, index, data.get('2'), data.get('5'), len(data)
+    (['a', 'c'], 1, [',1,3'], [',4,6'], 2)
     '''
-    data = defaultdict(list)
+    data = CompactTable()
     if isinstance(filename, basestring):
-        infile = open(filename)
+        infile = csvio.open_file(filename)
     else:
         infile = filename
     with infile as tableinput:
-        reader = csv.reader(tableinput)
+        reader = csvio.reader(tableinput)
         header = reader.next()
         DOCTESTDEBUG('header: %s', header)
-        if not key in header:
-            raise ValueError('Specified key "%s" not found in'
-                             ' right hand table headers %s' % (
-                             key, header))
-        index = header.index(key)
+        index = key_index(key, header, 'right')
         DOCTESTDEBUG('index of key %s: %d', key, index)
         right_header = [h for h in header if h != key]
         DOCTESTDEBUG('right header: %s', right_header)
         for row in reader:
-            trimmed = [row[i] for i in range(len(row)) if i != index]
+            trimmed = row[:index] + row[index + 1:]
             DOCTESTDEBUG('row: %s, trimmed: %s', row, trimmed)
             rowkey = row[index]
             DOCTESTDEBUG('rowkey: %s', rowkey)
-            if rowkey in data:
-                if not trimmed in data[rowkey]:
-                    data[rowkey].append(trimmed)
-                else:
-                    logging.debug('Discarding duplicate row'
-                                 ' in right-hand table: %s',
-                                 trimmed)
+            if not data.add(rowkey, splice(trimmed)):
+                logging.debug('Discarding duplicate row'
+                             ' in right-hand table: %s',
+                             trimmed)
+    logging.debug('data table for %s successfully built', filename)
+    return right_header, index, data
+
+@stats.stage('build_dict')
+def build_parsed(filename, key):
+    r'''
+    like build_dict, but the "dict" is a dict of the remaining columns of
+    each row as lists, for transform, which would otherwise have to parse
+    every row formatted by build_dict back into a list.
+
+    >>> from io import BytesIO
+    >>> build_parsed(BytesIO('a,b\n1,"x,y"\n1,"x,y"\n2\n3,\n'), 'a')
+    (['b'], 0, {'1': [['x,y']], '3': [['']], '2': [[]]})
+    '''
+    data = {}
+    if isinstance(filename, basestring):
+        infile = csvio.open_file(filename)
+    else:
+        infile = filename
+    with infile as tableinput:
+        reader = csvio.reader(tableinput)
+        header = reader.next()
+        index = key_index(key, header, 'right')
+        right_header = [h for h in header if h != key]
+        for row in reader:
+            rowkey = row[index]
+            trimmed = row[:index] + row[index + 1:]
+            rows = data.get(rowkey)
+            if rows is None:
+                data[rowkey] = [trimmed]
+            elif not trimmed in rows:
+                rows.append(trimmed)
             else:
-                data[rowkey].append(trimmed)
+                logging.debug('Discarding duplicate row'
+                              ' in right-hand table: %s', trimmed)
     logging.debug('data table for %s successfully built', filename)
-    return right_header, index, dict(data)
+    return right_header, index, data
+
+class CompactTable(object):
+    '''
+    read-mostly mapping of key to list of CSV-formatted rows.
+
+    all rows are kept end to end in one bytearray, with their starting
+    offsets in an array; a key maps to the number of its last row, and
+    `previous` has for each row the number of the one before it with the
+    same key, or -1, so that no per-key list is needed.
+
+    a duplicate is found by comparing a new row with the rows of its key,
+    which for most keys is one row, or none; only a key with more than
+    CHAIN rows gets a set of the hashes of its rows, so that it isn't
+    compared with every one of them.
+
+    >>> table = CompactTable()
+    >>> table.add('1', 'a,b'), table.add('1', 'c,d'), table.add('1', 'a,b')
+    (True, True, False)
+    >>> table.get('1'), table.get('2', [])
+    (['a,b', 'c,d'], [])
+    >>> [table.add('2', str(number)) for number in range(20)].count(True)
+    20
+    >>> table.add('2', '5'), table.add('2', '20'), len(table.get('2'))
+    (False, True, 21)
+    '''
+    # rows a key can have before its rows' hashes are kept in a set
+    CHAIN = 8
+
+    def __init__(self):
+        self.arena = bytearray()
+        self.starts = array('L', [0])
+        self.previous = array('l')
+        self.rows = {}
+        self.hashes = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, rowkey):
+        return rowkey in self.rows
+
+    def record(self, number):
+        return str(self.arena[self.starts[number]:self.starts[number + 1]])
+
+    def chain(self, number):
+        '''
+        the numbers of the rows of a key, from its last row, `number`, back
+        '''
+        while number >= 0:
+            yield number
+            number = self.previous[number]
+
+    def add(self, rowkey, text):
+        '''
+        add a row for rowkey unless it's a duplicate, returning True if added
+        '''
+        last = self.rows.get(rowkey)
+        if last is None:
+            last = -1
+        elif self.duplicate(rowkey, last, text):
+            return False
+        self.arena.extend(text)
+        self.starts.append(len(self.arena))
+        self.rows[rowkey] = len(self.previous)
+        self.previous.append(last)
+        return True
+
+    def duplicate(self, rowkey, last, text):
+        '''
+        whether text is already a row of rowkey, whose last row is `last`
+        '''
+        hashes = self.hashes.get(rowkey)
+        if hashes is not None:
+            duplicate = hash(text) in hashes and any(
+                self.record(number) == text for number in self.chain(last))
+            hashes.add(hash(text))
+            return duplicate
+        count, length = 0, len(text)
+        for number in self.chain(last):
+            if (self.starts[number + 1] - self.starts[number] == length and
+                    self.record(number) == text):
+                return True
+            count += 1
+        if count >= self.CHAIN:
+            self.hashes[rowkey] = set(hash(self.record(number))
+                                      for number in self.chain(last))
+            self.hashes[rowkey].add(hash(text))
+        return False
+
+    def get(self, rowkey, default=None):
+        number = self.rows.get(rowkey)
+        if number is None:
+            return default
+        if self.previous[number] < 0:
+            return [self.record(number)]
+        records = [self.record(number) for number in self.chain(number)]
+        records.reverse()
+        return records
+
+    def dump(self, outfile):
+        '''
+        write the table to outfile, for `load`; the arena raw, a block at a
+        time, since marshal can't save strings of 2G or more
+        '''
+        marshal.dump((len(self.arena), len(self.starts)), outfile, 2)
+        for start in xrange(0, len(self.arena), csvio.BLOCKSIZE):
+            outfile.write(buffer(self.arena, start, csvio.BLOCKSIZE))
+        self.starts.tofile(outfile)
+        self.previous.tofile(outfile)
+        marshal.dump(self.rows, outfile, 2)
+
+    @classmethod
+    def load(cls, infile):
+        '''
+        a table read from infile, as written by `dump`, for lookups only,
+        since the hashes of the rows of keys with many aren't kept
+
+        >>> table = CompactTable()
+        >>> table.add('1', 'a,b'), table.add('2', 'c,d')
+        (True, True)
+        >>> saved = tempfile.TemporaryFile()
+        >>> table.dump(saved); saved.seek(0)
+        >>> CompactTable.load(saved).get('2')
+        ['c,d']
+        '''
+        table = cls()
+        size, count = marshal.load(infile)
+        while len(table.arena) < size:
+            block = infile.read(min(csvio.BLOCKSIZE, size - len(table.arena)))
+            if not block:
+                raise EOFError('saved table truncated')
+            table.arena.extend(block)
+        table.starts = array('L')
+        table.starts.fromfile(infile, count)
+        table.previous = array('l')
+        table.previous.fromfile(infile, count - 1)
+        table.rows = marshal.load(infile)
+        return table
+
+def key_hash(value):
+    '''
+    64-bit big-endian hash of a key value, as stored in the index
+
+    >>> len(key_hash('12345'))
+    8
+    '''
+    return hashlib.md5(value).digest()[:8]
+
+def open_index(filename, key):
+    r'''
+    like build_dict, but returns a RightIndex in place of the dict,
+    (re)building the index file first if it is missing or stale.
+
+    the key and header are kept in the index's JSON as latin-1, which any
+    bytes decode as, as checkpoint.Checkpoint does.
+
+    >>> filename = tempfile.mkstemp(suffix='.csv')[1]
+    >>> with open(filename, 'wb') as outfile:
+    ...     outfile.write('id,it\x92s\n1,a\n')
+    >>> header, index, right = open_index(filename, 'id')
+    >>> header, index, right.get('1')
+    (['it\x92s'], 0, [',a'])
+    >>> open_index(filename, 'id')[0]
+    ['it\x92s']
+    >>> os.remove(filename), os.remove(filename + '.id.idx')
+    (None, None)
+    '''
+    if not os.path.isfile(filename):
+        raise ValueError('cannot index %s, not a regular file' % filename)
+    if csvio.is_compressed(filename):
+        raise ValueError('cannot index %s, a compressed file' % filename)
+    indexfile = '%s.%s.idx' % (filename, key.replace(os.sep, '_'))
+    stat = os.stat(filename)
+    stamp = {'size': stat.st_size, 'mtime': stat.st_mtime,
+             'key': key.decode('latin-1'), 'encoding': 'latin-1'}
+    try:
+        right_index = RightIndex(filename, indexfile, stamp)
+    except (IOError, ValueError) as stale:
+        logging.info('(re)building index %s: %s', indexfile, stale)
+        build_index(filename, indexfile, key, stamp)
+        right_index = RightIndex(filename, indexfile, stamp)
+    return right_index.header, right_index.index, right_index
+
+@stats.stage('build_index')
+def build_index(filename, indexfile, key, stamp):
+    '''
+    write the index: a JSON line with the stamp, the header, and the
+    key's column index, followed by 16-byte entries of key hash and row
+    offset, sorted, so that rows with the same key hash are adjacent and
+    in file order.
+
+    reading lines through `readline` rather than iterating on the file
+    keeps `tell` accurate, even for quoted values with embedded newlines.
+    '''
+    entries = []
+    with open(filename, 'rb') as tableinput:
+        reader = csv.reader(iter(tableinput.readline, ''))
+        header = reader.next()
+        index = key_index(key, header, 'right')
+        while True:
+            offset = tableinput.tell()
+            try:
+                row = reader.next()
+            except StopIteration:
+                break
+            entries.append(key_hash(row[index]) + struct.pack('>Q', offset))
+    entries.sort()
+    stamp = dict(stamp, header=[field.decode('latin-1') for field in header],
+                 index=index, count=len(entries))
+    temporary = indexfile + '.tmp'
+    with open(temporary, 'wb') as outfile:
+        outfile.write(json.dumps(stamp) + '\n')
+        outfile.write(''.join(entries))
+    os.rename(temporary, indexfile)
+    logging.debug('index %s of %d rows built', indexfile, len(entries))
+
+class RightIndex(object):
+    '''
+    read-only, dict-like view of a right-hand table through its index.
+
+    `get` returns, like the CompactTable built by build_dict, the list of
+    trimmed right rows for a key, as CSV, less any duplicates, or the
+    default if none.
+    '''
+    ENTRY = 16
+
+    def __init__(self, filename, indexfile, stamp):
+        with open(indexfile, 'rb') as infile:
+            stored = json.loads(infile.readline())
+            base = infile.tell()
+            if any(stored.get(k) != v for k, v in stamp.items()):
+                raise ValueError('stamp %s does not match %s' % (
+                    stored, stamp))
+            self.entries = mmap.mmap(infile.fileno(), 0,
+                                     access=mmap.ACCESS_READ)
+        with open(filename, 'rb') as tableinput:
+            self.table = mmap.mmap(tableinput.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        self.base, self.count = base, stored['count']
+        self.index = stored['index']
+        # json gives back unicode, but the csv module wants bytestrings
+        header = [h.encode('latin-1') for h in stored['header']]
+        key = stamp['key'].encode('latin-1')
+        self.header = [h for h in header if h != key]
+        if len(self.entries) != base + self.count * self.ENTRY:
+            raise ValueError('index %s is truncated' % indexfile)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, number):
+        '''
+        hash part of the numbered entry, so that bisect works on self
+        '''
+        offset = self.base + number * self.ENTRY
+        return self.entries[offset:offset + 8]
+
+    def row(self, offset):
+        '''
+        parse the CSV record starting at the given offset of the table
+        '''
+        self.table.seek(offset)
+        return csv.reader(iter(self.table.readline, '')).next()
+
+    def get(self, rowkey, default=None):
+        wanted = key_hash(rowkey)
+        number = bisect.bisect_left(self, wanted)
+        rows, unique = [], set()
+        while number < self.count and self[number] == wanted:
+            offset = self.base + number * self.ENTRY + 8
+            row = self.row(struct.unpack(
+                '>Q', self.entries[offset:offset + 8])[0])
+            number += 1
+            if row[self.index] != rowkey:
+                continue  # hash collision
+            trimmed = splice(row[:self.index] + row[self.index + 1:])
+            if not trimmed in unique:
+                unique.add(trimmed)
+                rows.append(trimmed)
+        return rows or default
+
+@stats.stage('open_sorted')
+def open_sorted(filename, key, order=True):
+    '''
+    like build_dict, but returns a SortedTable in place of the dict.
+
+    the file is left open, to be streamed from as the join goes on.
+    '''
+    if isinstance(filename, basestring):
+        infile = csvio.open_file(filename)
+    else:
+        infile = filename
+    reader = csvio.reader(infile)
+    header = reader.next()
+    index = key_index(key, header, 'right')
+    right_header = [h for h in header if h != key]
+    sortkey = numeric_order if order == 'numeric' else str
+    return right_header, index, SortedTable(reader, index, sortkey)
+
+def numeric_order(rowkey):
+    '''
+    sort key of a key for --sorted=numeric: numbers in numeric order, after
+    anything that isn't a number, such as an empty key, in string order, as
+    `LC_ALL=C sort -g` has them
+
+    >>> sorted(['10', '', '9', 'x', '-1e3', 'nan'], key=numeric_order)
+    ['', 'nan', 'x', '-1e3', '9', '10']
+    '''
+    try:
+        number = float(rowkey)
+    except ValueError:
+        return (0, rowkey)
+    if number != number:
+        return (0, rowkey)  # nan, which doesn't compare
+    return (1, number)
+
+class SortedTable(object):
+    '''
+    dict-like view of a right-hand table sorted on the key, for looking up
+    the keys of a left-hand table sorted the same way.
+
+    each `get` reads ahead in the right table until it reaches the key,
+    keeping only the (deduplicated) rows having that key. once the left
+    table is done, `finish` reads the rest of the right one, so that it is
+    checked to the end.
+
+    >>> table = SortedTable(csv.reader(['1,a', '1,a', '1,b', '3,c']), 0, str)
+    >>> table.get('0'), table.get('1'), table.get('1'), table.get('2', [])
+    (None, [',a', ',b'], [',a', ',b'], [])
+    >>> table.get('3'), table.get('4')
+    ([',c'], None)
+    >>> table.get('2')
+    Traceback (most recent call last):
+        ...
+    ValueError: left hand table not sorted: key '2' follows '4'
+    >>> table = SortedTable(csv.reader(['1,a', '5,b', '2,c']), 0, str)
+    >>> table.get('1')
+    [',a']
+    >>> table.finish()
+    Traceback (most recent call last):
+        ...
+    ValueError: right hand table not sorted: key '2' follows '5'
+    >>> table = SortedTable(csv.reader([',a', '2,b', '10,c']), 0,
+    ...                     numeric_order)
+    >>> table.get(''), table.get('x'), table.get('10')
+    ([',a'], None, [',c'])
+    '''
+    def __init__(self, reader, index, sortkey):
+        self.reader, self.index, self.sortkey = reader, index, sortkey
+        self.lastkey = self.lastorder = None
+        self.rowkey, self.order, self.rows = None, None, []
+        self.pending = None
+        self.advance()
+
+    def advance(self):
+        '''
+        read the next group of rows with the same key, if any
+        '''
+        row = self.pending or next(self.reader, None)
+        if row is None:
+            self.rowkey, self.order, self.rows = None, None, []
+            return
+        rowkey = row[self.index]
+        order = self.sortkey(rowkey)
+        if self.order is not None and order < self.order:
+            raise ValueError('right hand table not sorted: key %r follows %r'
+                             % (rowkey, self.rowkey))
+        self.rowkey, self.order, self.rows = rowkey, order, []
+        unique = set()
+        while row is not None and row[self.index] == rowkey:
+            trimmed = splice(row[:self.index] + row[self.index + 1:])
+            if not trimmed in unique:
+                unique.add(trimmed)
+                self.rows.append(trimmed)
+            else:
+                logging.debug('Discarding duplicate row'
+                              ' in right-hand table: %s', trimmed)
+            row = next(self.reader, None)
+        self.pending = row
+
+    def get(self, rowkey, default=None):
+        order = self.sortkey(rowkey)
+        if self.lastorder is not None and order < self.lastorder:
+            raise ValueError('left hand table not sorted: key %r follows %r'
+                             % (rowkey, self.lastkey))
+        self.lastkey, self.lastorder = rowkey, order
+        while self.rowkey is not None and self.order < order:
+            self.advance()
+        if self.rowkey == rowkey:
+            return self.rows
+        return default
+
+    def finish(self):
+        '''
+        read the rest of the right table, checking only its order
+        '''
+        rowkey, order = self.rowkey, self.order
+        row = self.pending
+        while row is not None:
+            if row[self.index] != rowkey:
+                previous, rowkey = rowkey, row[self.index]
+                last, order = order, self.sortkey(rowkey)
+                if last is not None and order < last:
+                    raise ValueError('right hand table not sorted: key %r'
+                                     ' follows %r' % (rowkey, previous))
+            row = next(self.reader, None)
+        self.rowkey, self.order, self.rows, self.pending = None, None, [], None
 
 if __name__ == '__main__':
-    process(*sys.argv[1:])
+    ARGS = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    OPTIONS = dict((arg[2:].split('=', 1) + [True])[:2]
+                   for arg in sys.argv[1:] if arg.startswith('--'))
+    process(*ARGS, **OPTIONS)
@@ -6,13 +6,22 @@ integers, in CSV files.
 for comparing output with Pandas-generated CSV, which has sane rules for
 floating point numbers, unlike Spark; and which trimmed the leading zeroes
 from numeric strings used as keys in some input files.
+
+with --jobs=N, the input is cut into chunks of whole records, which are
+processed by a pool of N processes, and written back in order.
 '''
 from __future__ import print_function
-import sys, os, csv, logging
+import sys, os, logging, multiprocessing
+from cStringIO import StringIO
+import csvio, stats
+from csvio import chunk_records
 logging.basicConfig(level=logging.DEBUG if __debug__ else logging.INFO)
 sys.setcheckinterval(1000000000)
+# the only characters a string that int() or float() accepts can start
+# with, once stripped: digits, sign, point, or inf[inity] or nan
+NUMERIC = frozenset('0123456789+-.iInN')
 
-def process(ints=False, zeroes=False, strings=False, na=False):
+def process(ints=False, zeroes=False, strings=False, na=False, jobs=0):
     '''
     default is simply to cut down floating point digits to minimum.
 
@@ -21,6 +30,58 @@ def process(ints=False, zeroes=False, strings=False, na=False):
      the integer zeroes as well, replacing with null ('')
     if strings==True, map str.strip to all strings.
     if na==True, replace the string na to ''.
+    if jobs is nonzero, use that many processes.
+    '''
+    if jobs:
+        return process_chunks((ints, zeroes, strings, na), int(jobs))
+    reader = csvio.reader()
+    writer = csvio.writer()
+    for row in transform(reader, ints, zeroes, strings, na):
+        try:
+            writer.writerow(row)
+        except IOError:
+            # assume pipeline was shut down
+            break
+
+def process_chunks(settings, jobs):
+    '''
+    process stdin in chunks in a pool of processes.
+    '''
+    chunks = chunk_records(csvio.stdin())
+    pool = multiprocessing.Pool(jobs)
+    outfile = stats.lines(csvio.stdout())
+    try:
+        for output in pool.imap(process_chunk, (
+                (chunk, settings) for chunk in chunks)):
+            outfile.write(output)
+        pool.close()
+    except IOError:
+        # assume pipeline was shut down
+        pool.terminate()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def process_chunk(args):
+    '''
+    run transform on one chunk of CSV, returning the output CSV
+    '''
+    chunk, settings = args
+    outfile = StringIO()
+    writer = csvio.writer(outfile)
+    writer.writerows(transform(csvio.reader(StringIO(chunk)), *settings))
+    return outfile.getvalue()
+
+def transform(rows, ints=False, zeroes=False, strings=False, na=False):
+    '''
+    the filtering as a generator of rows, used by process, and by
+    pipeline.py to run it on rows already parsed.
+
+    >>> list(transform(iter([['a', '1.50', '007'], ['b', ' 0.0', 'NA']]),
+    ...                True, True, True, True))
+    [['a', '1.5', '7'], ['b', '', '']]
     '''
     filters = [trim_numbers]
     zerolist = ['0.0', '0.00']
@@ -36,17 +97,11 @@ def process(ints=False, zeroes=False, strings=False, na=False):
             filters.append(remove_zeroes)
     if strings:  # trim everything before we convert to numbers
         filters.insert(0, trim_strings)
-    reader = csv.reader(sys.stdin)
-    writer = csv.writer(sys.stdout, lineterminator='\n')
     logging.debug('removing these zeroes: %s', zerolist)
-    for row in reader:
+    for row in rows:
         for munge in filters:
             row = munge(row, ints, zerolist)
-        try:
-            writer.writerow(row)
-        except IOError:
-            # assume pipeline was shut down
-            break
+        yield row
 
 def safe_number(string, ints):
     '''
@@ -70,8 +125,15 @@ def trim_numbers(row, ints, *ignored):
 
     remember, float() will gladly cast an integer as a float. so
     we need to prevent that.
+
+    values that can't start a number aren't tried at all, which saves
+    the cost of two exceptions each.
+
+    >>> trim_numbers(['x', '1.50', ' 2.0', 'nan', '007'], False)
+    ['x', '1.5', '2.0', 'nan', '007']
     '''
-    return [safe_number(number, ints) for number in row]
+    return [safe_number(value, ints) if value.lstrip()[:1] in NUMERIC
+            else value for value in row]
 
 def trim_strings(row, *ignored):
     '''
@@ -87,4 +149,8 @@ if __name__ == '__main__':
     # any non-null 2nd arg passed enables replacing zeroes with null ('').
     # any non-null 3rd arg passed enables trimming spaces from all strings.
     # any non-null 4th arg passed enables replacing NA with null ('').
-    process(*map(bool, sys.argv[1:]))
+    # --jobs=N uses N processes.
+    ARGS = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    OPTIONS = dict((arg[2:].split('=', 1) + [True])[:2]
+                   for arg in sys.argv[1:] if arg.startswith('--'))
+    process(*map(bool, ARGS), **OPTIONS)
@@ -0,0 +1,101 @@
+#!/usr/bin/python -OO
+'''
+run a chain of the CSV filters in this directory in a single process.
+
+instead of a shell pipeline, in which every stage parses and formats the
+CSV all over again, the stages are listed in a JSON file, e.g. joined.json:
+
+    {"input": ["$INPUT/data/billing.csv", "$INPUT/data/salesmen.csv"],
+     "stages": [["removeheaders"],
+                ["left_outer_join", "id", "$INPUT/calculated.csv"]]}
+
+which does the same as `make first third`. each stage is the name of a
+filter followed by its command-line args, and is run as that module's
+`transform`, a generator of rows. so the input is parsed once, and the
+output written once, to the "output" file if one is given, else stdout.
+"input" files are read one after the other, as `cat` would; if there are
+none, stdin is read. environment variables in any of the strings are
+expanded. input files may be gzip, bzip2 or xz compressed, and the output
+file is compressed if its name ends in .gz, .bz2 or .xz.
+
+the output is the same, byte for byte, as that of the shell pipeline. the
+rows are written with csvio.Writer, which quotes them just as every filter
+that writes rows does; and if no stage does, but each only drops lines, as
+removeheaders does, the lines are copied as they are, with their own
+quoting and line ends, by each stage's `transform_lines`.
+'''
+from __future__ import print_function
+import sys, os, json, logging
+from itertools import chain
+import csvio
+logging.basicConfig(level=logging.DEBUG if __debug__ else logging.INFO)
+sys.setcheckinterval(1000000000)
+
+def process(specfile):
+    '''
+    run the pipeline described in specfile
+    '''
+    with open(specfile) as infile:
+        spec = expand(json.load(infile))
+    inputs = spec.get('input', [])
+    if isinstance(inputs, basestring):
+        inputs = [inputs]
+    if inputs:
+        lines = chain.from_iterable(csvio.open_file(filename)
+                                    for filename in inputs)
+    else:
+        lines = csvio.stdin()
+    stages = spec['stages']
+    if spec.get('output'):
+        outfile = csvio.open_file(spec['output'], 'wb')
+    else:
+        outfile = csvio.stdout()
+    try:
+        if all(hasattr(__import__(stage[0]), 'transform_lines')
+               for stage in stages):
+            outfile.writelines(build(iter(lines), stages, 'transform_lines'))
+        else:
+            csvio.writer(outfile).writerows(build(csvio.reader(lines), stages))
+    except IOError:
+        logging.debug('apparently pipeline was shut down')
+    finally:
+        if spec.get('output'):
+            outfile.close()
+
+def build(rows, stages, transform='transform'):
+    '''
+    chain the transforms of each of the stages onto rows, or with
+    `transform` of 'transform_lines', onto lines
+
+    >>> list(build(iter([['id', 'a'], ['1', '2.50'], ['id', 'a']]),
+    ...            [['removeheaders'], ['min_digits']]))
+    [['id', 'a'], ['1', '2.5']]
+    '''
+    for stage in stages:
+        name, args = stage[0], stage[1:]
+        module = __import__(name)
+        if not hasattr(module, transform):
+            raise ValueError('%s cannot be used as a pipeline stage' % name)
+        logging.debug('adding stage %s %s', name, args)
+        rows = getattr(module, transform)(rows, *args)
+    return rows
+
+def expand(value):
+    '''
+    expand environment variables in the strings of a JSON value, and make
+    them bytestrings, as the csv module expects.
+
+    >>> os.environ['INPUT'] = '/tmp/example'
+    >>> expand({u'input': [u'$INPUT/data/sales.csv', 1, True]})
+    {'input': ['/tmp/example/data/sales.csv', 1, True]}
+    '''
+    if isinstance(value, dict):
+        return dict((expand(key), expand(item)) for key, item in value.items())
+    elif isinstance(value, list):
+        return [expand(item) for item in value]
+    elif isinstance(value, unicode):
+        return os.path.expandvars(value.encode('utf8'))
+    return value
+
+if __name__ == '__main__':
+    process(*sys.argv[1:])
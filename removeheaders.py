@@ -7,23 +7,244 @@ _directory_ called /tmp/output.csv, and put in it (if successful) a bunch of
 files part-00000-somethingsomething.csv, part-00001-somethingsomething.csv,
 etc, and a _SUCCESS file. this filter expects all lines of all files in order
 and removes every header _except for the very first one_.
+
+much faster is to give it the part files, or the directory, as args, e.g.
+`./removeheaders.py /tmp/output.csv`. then it drops the first line of each file
+but the first that isn't empty (Spark writes empty partitions as empty files,
+without even a header), and copies the rest in big blocks, without looking at
+the lines at all; and reads ahead in several files at once (4 by default, or
+--readahead=N), in background threads, while writing them in order. the files
+may be gzip, bzip2 or xz compressed, as Spark can write them.
+
+any part file in the columnar format of columnar.py is read as rows and
+written as CSV, by its reader thread; if the output is to be columnar, all
+the rows are read and written instead.
 '''
 from __future__ import print_function
-import sys, os
+import sys, os, errno, threading, Queue
+from collections import deque
+from cStringIO import StringIO
+import csvio, stats
 sys.setcheckinterval(1000000000)
+BLOCKSIZE = 1024 * 1024
+# number of blocks read ahead in each file
+QUEUED = 8
+
+def process(*filenames, **options):
+    '''
+    remove the extra headers from stdin, or from the given files, or the
+    files in the given directory, in which case concatenate does the work.
+    '''
+    readahead = int(options.pop('readahead', 4))
+    if options:
+        raise TypeError('unknown options %s' % options)
+    outfile = csvio.stdout()
+    rows = isinstance(outfile, csvio.ColumnarText)
+    if filenames:
+        filenames = expand(filenames)
+        try:
+            if rows:
+                return concatenate_rows(filenames, csvio.writer(outfile))
+            return concatenate(filenames, stats.lines(outfile), readahead)
+        except IOError as failed:
+            if failed.errno != errno.EPIPE:
+                raise
+            return  # ignore broken pipe
+    if rows or csvio.is_columnar(csvio.stdin()):
+        try:
+            csvio.writer(outfile).writerows(transform(csvio.reader()))
+        except IOError:  # broken pipe, most likely
+            pass  # ignore it
+        except StopIteration:
+            pass  # no input at all
+        return
+    outfile = stats.lines(outfile)
+    try:
+        for line in transform_lines(csvio.stdin()):
+            outfile.write(line)  # still has its own EOL character(s)
+    except IOError:  # broken pipe, most likely
+        return  # ignore it
+
+def expand(filenames):
+    '''
+    list of files, with any directories replaced by the files in them,
+    less Spark's _SUCCESS, .crc, and such.
+
+    >>> expand([os.devnull])
+    ['/dev/null']
+    '''
+    expanded = []
+    for filename in filenames:
+        if os.path.isdir(filename):
+            expanded.extend(os.path.join(filename, name)
+                            for name in sorted(os.listdir(filename))
+                            if not name.startswith(('_', '.')))
+        else:
+            expanded.append(filename)
+    return expanded
+
+def concatenate(filenames, outfile, readahead=4):
+    r'''
+    write the files to outfile, less the first line of all but the first
+    that isn't empty.
+
+    each file is read in a thread of its own, started up to `readahead`
+    files in advance, into a bounded queue of its first line and then
+    blocks.
+
+    >>> import tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> open(os.path.join(directory, 'part-0'), 'w').close()
+    >>> for number in range(1, 4):
+    ...     name = os.path.join(directory, 'part-%d' % number)
+    ...     with open(name, 'w') as part:
+    ...         part.write('a,b\n%d,%d\n' % (number, number))
+    >>> concatenate(expand([directory]), sys.stdout, 2)
+    a,b
+    1,1
+    2,2
+    3,3
+    '''
+    pending = deque()
+    files = iter(filenames)
+    header = None
+    while True:
+        for filename in files:
+            blocks = Queue.Queue(QUEUED)
+            thread = threading.Thread(target=read_blocks,
+                                      args=(filename, blocks))
+            thread.daemon = True  # don't wait for it after a broken pipe
+            thread.start()
+            pending.append(blocks)
+            if len(pending) >= readahead:
+                break
+        if not pending:
+            break
+        blocks = pending.popleft()
+        first = True
+        while True:
+            block = blocks.get()
+            if isinstance(block, Exception):
+                raise block
+            elif first:
+                first = False
+                if header is None and block:
+                    header = block
+                    outfile.write(block)
+                continue
+            elif not block:
+                break
+            outfile.write(block)
+    outfile.flush()
+
+def concatenate_rows(filenames, writer):
+    r'''
+    write the rows of the files with writer, less the first row of all but
+    the first that isn't empty.
+
+    >>> import tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> open(os.path.join(directory, 'part-0'), 'w').close()
+    >>> for number in range(1, 3):
+    ...     name = os.path.join(directory, 'part-%d' % number)
+    ...     with open(name, 'w') as part:
+    ...         part.write('a,b\n%d,"x\ny"\n' % number)
+    >>> concatenate_rows(expand([directory]), csvio.Writer(sys.stdout))
+    a,b
+    1,"x
+    y"
+    2,"x
+    y"
+    '''
+    header = None
+    for filename in filenames:
+        with csvio.open_file(filename) as infile:
+            reader = csvio.reader(infile)
+            first = next(reader, None)
+            if header is None and first is not None:
+                header = first
+                writer.writerow(header)
+            writer.writerows(reader)
+
+def read_blocks(filename, blocks):
+    '''
+    queue up the first line of a file, '' if it's empty, then the blocks of
+    the rest, ending with an empty one, or the exception if there was one.
+    a columnar file is queued as CSV in the same way.
+    '''
+    try:
+        with csvio.open_file(filename) as infile:
+            if csvio.is_columnar(infile):
+                for block in csv_blocks(csvio.reader(infile)):
+                    blocks.put(block)
+            else:
+                blocks.put(infile.readline())
+                block = True
+                while block:
+                    block = infile.read(BLOCKSIZE)
+                    blocks.put(block)
+    except (IOError, OSError, ValueError) as failed:
+        blocks.put(failed)
+
+def csv_blocks(rows):
+    r'''
+    the rows as CSV, as read_blocks queues a file: the header, then blocks
+    of about BLOCKSIZE, then ''
+
+    >>> list(csv_blocks(iter([['a'], ['1'], ['2']])))
+    ['a\n', '1\n2\n', '']
+    >>> list(csv_blocks(iter([])))
+    ['', '']
+    '''
+    outfile = StringIO()
+    writer = csvio.Writer(outfile)
+    header = next(rows, None)
+    if header is None:
+        yield ''
+    else:
+        writer.writerow(header)
+        for row in rows:
+            if outfile.tell() >= BLOCKSIZE or header is not None:
+                yield outfile.getvalue()
+                outfile.seek(0)
+                outfile.truncate()
+                header = None
+            writer.writerow(row)
+        yield outfile.getvalue()
+    yield ''
+
+def transform_lines(lines):
+    r'''
+    the lines, less any equal to the first, as the filter does to stdin,
+    and pipeline.py to its input when no stage needs it parsed
+
+    >>> list(transform_lines(iter(['id\n', '1\n', 'id\n', '"2"\n'])))
+    ['id\n', '1\n', '"2"\n']
+    '''
+    header = next(lines, None)
+    if header is None:
+        return
+    yield header
+    for line in lines:
+        if line != header:
+            yield line
+
+def transform(rows):
+    '''
+    the same for rows already parsed, as used by pipeline.py: drop every
+    row equal to the first one.
 
-def process():
-    sent_header = None
-    for line in sys.stdin:
-        if sent_header is None:
-            header = line
-            print(line, end='')  # still has its own EOL character(s)
-            sent_header = True
-        elif not line == header:
-            try:
-                print(line, end='')
-            except IOError:  # broken pipe, most likely
-                return  # ignore it
+    >>> list(transform(iter([['id'], ['1'], ['id'], ['2']])))
+    [['id'], ['1'], ['2']]
+    '''
+    header = next(rows)
+    yield header
+    for row in rows:
+        if row != header:
+            yield row
 
 if __name__ == '__main__':
-    process()
+    ARGS = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    OPTIONS = dict((arg[2:].split('=', 1) + [True])[:2]
+                   for arg in sys.argv[1:] if arg.startswith('--'))
+    process(*ARGS, **OPTIONS)
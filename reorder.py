@@ -10,7 +10,8 @@ rows; it will reorder them all, and send them to the header remover that
 is the next program in the pipeline.
 '''
 from __future__ import print_function
-import sys, os, csv, logging
+import sys, os, logging
+import csvio
 logging.basicConfig(level=logging.DEBUG if __debug__ else logging.INFO)
 sys.setcheckinterval(1000000000)
 
@@ -26,12 +27,26 @@ def process():
     or shorter, than the disordered columns, since the disordering is
     expected to have resulted from a Spark df.join().
     '''
-    reader = csv.reader(sys.stdin)
-    writer = csv.writer(sys.stdout, lineterminator='\n')
-    row = reader.next()
+    reader = csvio.reader()
+    writer = csvio.writer()
+    for row in transform(reader):
+        try:
+            writer.writerow(row)
+        except IOError:  # broken pipe from `head` likely
+            break  # ignore it
+
+def transform(rows):
+    '''
+    the reordering as a generator of rows, used by process, and by
+    pipeline.py to run it on rows already parsed.
+
+    >>> list(transform(iter([['a', 'b'], ['b', 'a', 'c'], ['2', '1', '3']])))
+    [['a', 'b', 'c'], ['1', '2', '3']]
+    '''
+    row = next(rows)
     logging.debug('setting reference to %s', row)
     reference = row
-    row = reader.next()
+    row = next(rows)
     logging.debug('setting disordered to %s', row)
     disordered = row
     try:
@@ -43,12 +58,9 @@ def process():
     # position in the list
     while reindex and reindex[-1] == len(reindex) - 1:
         reindex.pop(-1)
-    writer.writerow(reference + disordered[len(reference):])
-    for row in reader:
-        try:
-            writer.writerow(reorder(row, reindex))
-        except IOError:  # broken pipe from `head` likely
-            break  # ignore it
+    yield reference + disordered[len(reference):]
+    for row in rows:
+        yield reorder(row, reindex)
 
 def reorder(row, order):
     '''
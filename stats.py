@@ -0,0 +1,309 @@
+'''
+progress, throughput and timing of a filter, for when it runs for hours.
+
+off unless $STATS is set, to '-' for stderr or else the name of a file to
+append to, which a whole pipeline of filters can share. then every
+$STATS_INTERVAL seconds (10 by default) a line is written of the rows read
+(twice, if read twice, as by deduplicate's 'all') and written so far, and
+their rates; the bytes read and written, from /proc/self/io, so including
+any right-hand table or spill file; and the resident set size. at exit, a
+last line gives the time spent in each of:
+    parse   reading and parsing input, in csvio.reader
+    write   formatting and writing output, with csvio.writer
+    other   the filter's own work, the rest of the time
+and in any stages the filter marks with `timed` or `stage`, such as
+left_outer_join's build_dict and probe, whose times include any parsing
+and writing in them.
+
+each line starts with the name of the filter and its process id. rows
+handled in worker processes, with --workers or --jobs, are not counted,
+only the bytes that the parent reads and writes.
+'''
+from __future__ import print_function
+import sys, os, time, threading, atexit, logging
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from itertools import islice
+try:
+    import resource
+except ImportError:
+    resource = None
+# rows passed to a writer's writerows at a time, timing each batch
+BATCH = 1024
+
+class Stats(object):
+    '''
+    counts of rows and seconds, reported to outfile every interval seconds
+    and at exit
+    '''
+    def __init__(self, outfile, interval=10):
+        self.outfile, self.interval = outfile, interval
+        self.name = '%s[%d]' % (os.path.basename(sys.argv[0]), os.getpid())
+        self.started = time.time()
+        self.rows_in = self.rows_out = 0
+        self.seconds = defaultdict(float)
+        # stage names in the order first timed
+        self.stages = []
+
+    def start(self):
+        '''
+        start reporting, in a background thread, and at exit
+        '''
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        atexit.register(self.finish)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.write(self.progress())
+
+    def write(self, line):
+        self.outfile.write('%s %s\n' % (self.name, line))
+        self.outfile.flush()
+
+    def add(self, name, seconds):
+        if not name in self.seconds and not name in ('parse', 'write'):
+            self.stages.append(name)
+        self.seconds[name] += seconds
+
+    def progress(self):
+        '''
+        a line of the rows and bytes so far, and the rates of each
+        '''
+        elapsed = max(time.time() - self.started, 1e-9)
+        parts = ['%s in %d rows %.0f/s, out %d rows %.0f/s' % (
+            duration(elapsed), self.rows_in, self.rows_in / elapsed,
+            self.rows_out, self.rows_out / elapsed)]
+        io = io_bytes()
+        if io:
+            parts.append('read %s %s/s, written %s %s/s' % (
+                megabytes(io[0]), megabytes(io[0] / elapsed),
+                megabytes(io[1]), megabytes(io[1] / elapsed)))
+        parts.append('rss %s' % megabytes(rss()))
+        return ', '.join(parts)
+
+    def summary(self):
+        '''
+        a line of the time in parse, write and the rest, and in each stage
+
+        >>> stats = Stats(None)
+        >>> stats.started -= 10
+        >>> stats.add('build_dict', 4.0)
+        >>> stats.add('parse', 5.0)
+        >>> for part in stats.summary().split(';'):  # doctest: +ELLIPSIS
+        ...     print(part)
+        done in 10.0s: parse 5.0s 50%, write 0.0s 0%, other 5.0s 50%
+         build_dict 4.0s
+         peak rss ...MB
+        '''
+        elapsed = max(time.time() - self.started, 1e-9)
+        other = elapsed - self.seconds['parse'] - self.seconds['write']
+        parts = ['done in %.1fs: %s' % (elapsed, ', '.join(
+            '%s %.1fs %.0f%%' % (name, seconds, 100 * seconds / elapsed)
+            for name, seconds in [('parse', self.seconds['parse']),
+                                  ('write', self.seconds['write']),
+                                  ('other', other)]))]
+        if self.stages:
+            parts.append(' ' + ', '.join('%s %.1fs' % (
+                name, self.seconds[name]) for name in self.stages))
+        parts.append(' peak rss %s' % megabytes(peak_rss()))
+        return ';'.join(parts)
+
+    def finish(self):
+        self.write(self.progress())
+        self.write(self.summary())
+
+@contextmanager
+def timed(name):
+    '''
+    add the time spent in the block to that of the stage `name`
+    '''
+    if STATS is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        STATS.add(name, time.time() - start)
+
+def stage(name):
+    '''
+    decorator timing every call of a function as the stage `name`, if
+    $STATS is set
+    '''
+    def decorate(function):
+        if STATS is None:
+            return function
+        @wraps(function)
+        def timed_function(*args, **kwargs):
+            with timed(name):
+                return function(*args, **kwargs)
+        return timed_function
+    return decorate
+
+def parsed(batches):
+    '''
+    the batches of rows, counted, and the time getting each one added to
+    'parse'
+    '''
+    if STATS is None:
+        for batch in batches:
+            yield batch
+        return
+    while True:
+        start = time.time()
+        batch = next(batches, None)
+        STATS.seconds['parse'] += time.time() - start
+        if batch is None:
+            return
+        STATS.rows_in += len(batch)
+        yield batch
+
+def counted(writer):
+    '''
+    writer, or if $STATS is set, a Counted wrapper of it, unless it writes
+    to Lines, which count it already
+    '''
+    if STATS is None or isinstance(getattr(writer, 'outfile', None), Lines):
+        return writer
+    return Counted(writer)
+
+def lines(outfile):
+    '''
+    outfile, or if $STATS is set, a Lines wrapper of it, for filters that
+    write CSV text themselves
+    '''
+    return outfile if STATS is None else Lines(outfile)
+
+class Counted(object):
+    '''
+    wrapper of a writer, counting the rows it writes, and adding the time
+    it takes to 'write'
+    '''
+    def __init__(self, writer):
+        self.writer = writer
+
+    def __getattr__(self, name):
+        return getattr(self.writer, name)
+
+    def writerow(self, row):
+        start = time.time()
+        self.writer.writerow(row)
+        STATS.seconds['write'] += time.time() - start
+        STATS.rows_out += 1
+
+    def writerows(self, rows):
+        '''
+        write rows BATCH at a time, so that the time taken to produce
+        them, by a reader or a generator, isn't counted as writing
+        '''
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, BATCH))
+            if not batch:
+                break
+            start = time.time()
+            self.writer.writerows(batch)
+            STATS.seconds['write'] += time.time() - start
+            STATS.rows_out += len(batch)
+
+class Lines(object):
+    '''
+    wrapper of a file, counting the lines written to it as rows, and
+    adding the time it takes to 'write'
+    '''
+    def __init__(self, outfile):
+        self.outfile = outfile
+
+    def __getattr__(self, name):
+        return getattr(self.outfile, name)
+
+    def write(self, text):
+        start = time.time()
+        self.outfile.write(text)
+        STATS.seconds['write'] += time.time() - start
+        STATS.rows_out += text.count('\n')
+
+def count(rows_in=0):
+    '''
+    count rows read other than through `parsed`
+    '''
+    if STATS is not None:
+        STATS.rows_in += rows_in
+
+def io_bytes():
+    '''
+    bytes read and written by this process so far, or None if unknown
+    '''
+    try:
+        with open('/proc/self/io') as infile:
+            fields = dict(line.split(':') for line in infile)
+        return int(fields['rchar']), int(fields['wchar'])
+    except (IOError, KeyError, ValueError):
+        return None
+
+def rss():
+    '''
+    resident set size in bytes, or else the peak of it
+    '''
+    try:
+        with open('/proc/self/statm') as infile:
+            return int(infile.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, IndexError, ValueError, OSError):
+        return peak_rss()
+
+def peak_rss():
+    '''
+    peak resident set size in bytes, or 0 if unknown
+    '''
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux gives it in kilobytes, BSD and OS X in bytes
+    return peak * 1024 if sys.platform.startswith('linux') else peak
+
+def megabytes(size):
+    '''
+    size in bytes, in megabytes
+
+    >>> megabytes(3 * 1024 * 1024 / 2)
+    '1.5MB'
+    '''
+    return '%.1fMB' % (size / 1024.0 / 1024)
+
+def duration(seconds):
+    '''
+    seconds as hours, minutes and seconds
+
+    >>> duration(3725.5)
+    '1:02:05'
+    '''
+    minutes, seconds = divmod(int(seconds), 60)
+    return '%d:%02d:%02d' % (minutes // 60, minutes % 60, seconds)
+
+def from_environment():
+    '''
+    a started Stats as set up by $STATS and $STATS_INTERVAL, or None
+    '''
+    destination = os.environ.get('STATS')
+    if not destination:
+        return None
+    if destination == '-':
+        outfile = sys.stderr
+    else:
+        try:
+            outfile = open(destination, 'a', 1)
+        except IOError as failed:
+            logging.warning('cannot write stats to %s: %s',
+                            destination, failed)
+            return None
+    stats = Stats(outfile, float(os.environ.get('STATS_INTERVAL', 10)))
+    stats.start()
+    return stats
+
+# the Stats of this process, if $STATS is set
+STATS = from_environment()